@@ -0,0 +1,307 @@
+"""
+Load generation and benchmarks for quanda's busiest views.
+
+seed() fills the database with a synthetic corpus whose votes, views and
+answers are skewed the way real traffic is: a few questions get most of the
+attention. run() then drives the views through the django test client and
+reports, per view, the latency percentiles, queries per request and memory
+allocated per request (or kept alive by it, on python 2). See the
+quanda_benchmark management command.
+
+Both run in a cache of their own (see use_cache), so the ids of the
+throwaway database never meet the site's cache.
+
+run() can also add a fixed delay to every query, to see how the views would
+fare against a database across the network, where running queries
+concurrently (see quanda.parallel) pays off.
+"""
+
+import datetime
+import gc
+import random
+import sys
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import cache as cache_module
+from django.core.cache import get_cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, reset_queries, transaction
+from django.db.backends.util import CursorDebugWrapper
+from django.test.client import Client
+
+from quanda.models import Question, QuestionVote, QuestionView, QuestionTag, Answer, AnswerVote, Profile, Comment
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+BENCHMARK_PASSWORD = 'benchmark'
+
+WORDS = """
+python django database query index cache template view model form vote
+answer question tag feed search user profile session server request
+response latency memory thread process deploy install upgrade migrate
+error exception debug log test unicode string list dict class function
+""".split()
+
+def skewed_index(count, skew=3.0):
+    """
+    Returns an index in [0, count) following a power law: with the default
+    skew about half the picks land in the first 10% of the range.
+    """
+    return min(int(count * (random.random() ** skew)), count - 1)
+
+def sentence(words=8):
+    return ' '.join([random.choice(WORDS) for i in range(words)])
+
+@transaction.commit_on_success
+def seed(users=100, questions=1000, answers=3000, votes=20000, views=50000,
+         tags=50, comments=5000, random_seed=0):
+    "Creates the synthetic corpus. Meant to run on an empty (test) database."
+    random.seed(random_seed)
+    now = datetime.datetime.now()
+
+    user_list = []
+    for i in range(users):
+        user = User(username='bench%s' % i)
+        user.set_password(BENCHMARK_PASSWORD)
+        user.save()
+        # enough rep to vote and comment
+        Profile.objects.create(user=user, reputation=1000)
+        user_list.append(user)
+    User.objects.get_or_create(username='anonymous_user')
+
+    tag_list = [QuestionTag.objects.create(title='%s%s' % (random.choice(WORDS), i))
+                for i in range(tags)]
+
+    question_list = []
+    for i in range(questions):
+        question = Question.objects.create(
+            title=sentence(6),
+            question_text=sentence(60),
+            author=user_list[skewed_index(users)],
+            posted=now - datetime.timedelta(minutes=questions - i),
+        )
+        for j in range(random.randint(0, 3)):
+            tag_list[skewed_index(tags)].questions.add(question)
+        question_list.append(question)
+    # the most recent questions are the busiest ones
+    question_list.reverse()
+
+    answer_list = []
+    answered = set()
+    for i in range(answers):
+        question = question_list[skewed_index(questions)]
+        author = user_list[random.randrange(users)]
+        if (question.id, author.id) in answered:
+            continue
+        answered.add((question.id, author.id))
+        answer_list.append(Answer.objects.create(
+            question=question,
+            answer_text=sentence(40),
+            author=author,
+            posted=question.posted + datetime.timedelta(seconds=i),
+        ))
+
+    voted = set()
+    for i in range(votes):
+        user = user_list[random.randrange(users)]
+        score = random.random() < 0.8 and 1 or -1
+        if random.random() < 0.5 or not answer_list:
+            question = question_list[skewed_index(questions)]
+            if ('q', question.id, user.id) not in voted:
+                voted.add(('q', question.id, user.id))
+                QuestionVote.objects.create(question=question, user=user, score=score)
+        else:
+            answer = answer_list[skewed_index(len(answer_list))]
+            if ('a', answer.id, user.id) not in voted:
+                voted.add(('a', answer.id, user.id))
+                AnswerVote.objects.create(answer=answer, user=user, score=score)
+
+    for i in range(views):
+        QuestionView.objects.create(question=question_list[skewed_index(questions)],
+                                    ip='127.0.0.1', session='bench%s' % i)
+
+    for i in range(comments):
+        if random.random() < 0.5 or not answer_list:
+            target = question_list[skewed_index(questions)]
+        else:
+            target = answer_list[skewed_index(len(answer_list))]
+        Comment.objects.create(content_object=target, comment_text=sentence(12),
+                               user=user_list[random.randrange(users)],
+                               ip='127.0.0.1')
+
+    # fill in everything derived from the corpus
+    for command in ('rebuild_counters', 'rebuild_reputation',
+                    'rebuild_search_index', 'rebuild_related_questions'):
+        call_command(command, verbosity=0)
+
+def use_cache(backend):
+    """
+    Points django's cache, and every module that imported it, at a new cache
+    with the given backend uri ('locmem://', or 'dummy://' for no caching at
+    all). Returns the function pointing them back.
+    """
+    old, new = cache_module.cache, get_cache(backend)
+    modules = [module for module in sys.modules.values()
+               if getattr(module, 'cache', None) is old]
+    for module in modules:
+        module.cache = new
+    def restore():
+        for module in modules:
+            module.cache = old
+    return restore
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[int(round(percent / 100.0 * (len(values) - 1)))]
+
+def _memory_mark():
+    if tracemalloc is None:
+        # the objects alive before the request
+        gc.collect()
+        return set([id(obj) for obj in gc.get_objects()])
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    return tracemalloc.get_traced_memory()[0]
+
+def _memory_used(mark):
+    """
+    Kilobytes allocated at the peak since mark, or still allocated when the
+    peak can't be reset (tracemalloc before python 3.9). Without tracemalloc
+    (python 2), the kilobytes taken by the objects created since mark that
+    are still alive, as seen by the garbage collector: the process' peak rss
+    only ever grows, so it says nothing about a single request.
+    """
+    if tracemalloc is None:
+        gc.collect()
+        return sum([sys.getsizeof(obj) for obj in gc.get_objects()
+                    if id(obj) not in mark and obj is not mark]) / 1024.0
+    current, peak = tracemalloc.get_traced_memory()
+    if hasattr(tracemalloc, 'reset_peak'):
+        return (peak - mark) / 1024.0
+    return (current - mark) / 1024.0
+
+def get_scenarios():
+    """
+    Returns (name, method, url maker, logged in) tuples for the benchmarked
+    views. The url makers pick their target with the same skew as the corpus.
+    """
+    question_ids = list(Question.objects.order_by('-posted').values_list('id', flat=True))
+    answer_ids = list(Answer.objects.order_by('-posted').values_list('id', flat=True))
+    usernames = list(User.objects.filter(username__startswith='bench')
+                     .values_list('username', flat=True))
+
+    def question():
+        return question_ids[skewed_index(len(question_ids))]
+    def answer():
+        return answer_ids[skewed_index(len(answer_ids))]
+    def vote_direction():
+        return random.random() < 0.5 and 'up' or 'down'
+
+    return [
+        ('index', 'get', lambda: reverse('quanda_index'), False),
+        ('question_read', 'get', lambda: reverse('quanda_question_read', args=[question()]), False),
+        ('question_read_logged_in', 'get', lambda: reverse('quanda_question_read', args=[question()]), True),
+        ('record_view', 'get', lambda: reverse('quanda_record_view', args=[question()]), False),
+        ('question_vote', 'get', lambda: reverse('quanda_question_vote_%s' % vote_direction(), args=[question()]), True),
+        ('answer_vote', 'get', lambda: reverse('quanda_answer_vote_%s' % vote_direction(), args=[answer()]), True),
+        ('search', 'get', lambda: '%s?query=%s' % (reverse('quanda_search'), '+'.join(random.sample(WORDS, 2))), False),
+        ('profile', 'get', lambda: reverse('quanda_public_profile', args=[random.choice(usernames)]), False),
+        ('feed_latest', 'get', lambda: reverse('quanda_feed', args=['latest']), False),
+        ('feed_answers', 'get', lambda: reverse('quanda_feed', args=['answers/%s' % question()]), False),
+    ]
+
+def _add_latency(db_latency):
+    """
+    Makes every query wait db_latency milliseconds first (debug cursors
+    only, which run() uses). Returns the function undoing it.
+    """
+    execute, executemany = CursorDebugWrapper.execute, CursorDebugWrapper.executemany
+    def slow_execute(self, *args, **kwargs):
+        time.sleep(db_latency / 1000.0)
+        return execute(self, *args, **kwargs)
+    def slow_executemany(self, *args, **kwargs):
+        time.sleep(db_latency / 1000.0)
+        return executemany(self, *args, **kwargs)
+    CursorDebugWrapper.execute = slow_execute
+    CursorDebugWrapper.executemany = slow_executemany
+    def restore():
+        CursorDebugWrapper.execute = execute
+        CursorDebugWrapper.executemany = executemany
+    return restore
+
+def run(requests=200, only=None, random_seed=0, db_latency=0):
+    """
+    Drives every scenario `requests` times and returns a dict of scenario
+    name to its measurements. db_latency is added to every query, in
+    milliseconds.
+    """
+    random.seed(random_seed)
+    old_debug = settings.DEBUG
+    # connection.queries is only filled in debug mode
+    settings.DEBUG = True
+    restore_latency = None
+    if db_latency:
+        restore_latency = _add_latency(db_latency)
+    if tracemalloc:
+        tracemalloc.start()
+
+    anonymous = Client()
+    logged_in = Client()
+    voter = User.objects.filter(username__startswith='bench').order_by('-id')[0]
+    logged_in.login(username=voter.username, password=BENCHMARK_PASSWORD)
+
+    results = {}
+    try:
+        for name, method, make_url, login in get_scenarios():
+            if only and name not in only:
+                continue
+            client = login and logged_in or anonymous
+            timings, queries, memory = [], [], []
+            for i in range(requests):
+                url = make_url()
+                reset_queries()
+                mark = _memory_mark()
+                start = time.time()
+                response = getattr(client, method)(url)
+                timings.append((time.time() - start) * 1000)
+                memory.append(_memory_used(mark))
+                queries.append(len(connection.queries))
+                if response.status_code >= 400:
+                    raise RuntimeError("%s returned %s for %s" % (
+                        name, response.status_code, url))
+            results[name] = {
+                'requests': requests,
+                'p50_ms': round(percentile(timings, 50), 3),
+                'p99_ms': round(percentile(timings, 99), 3),
+                'mean_ms': round(sum(timings) / len(timings), 3),
+                'queries_mean': round(float(sum(queries)) / len(queries), 2),
+                'queries_max': max(queries),
+                'memory_kb_mean': round(sum(memory) / len(memory), 1),
+            }
+    finally:
+        settings.DEBUG = old_debug
+        if restore_latency:
+            restore_latency()
+        if tracemalloc:
+            tracemalloc.stop()
+    return results
+
+def compare(previous, current):
+    "Returns the lines of a report comparing two sets of results"
+    lines = ['%-24s %12s %12s %12s' % ('view', 'p50 ms', 'p99 ms', 'queries')]
+    for name in sorted(current):
+        now, before = current[name], previous.get(name)
+        def column(key):
+            if before is None or not before.get(key):
+                return '%s' % now[key]
+            change = 100.0 * (now[key] - before[key]) / before[key]
+            return '%s (%+.0f%%)' % (now[key], change)
+        lines.append('%-24s %12s %12s %12s' % (
+            name, column('p50_ms'), column('p99_ms'), column('queries_mean')))
+    return lines
@@ -0,0 +1,230 @@
+"""
+Page and fragment caching for quanda.
+
+Everything quanda caches is stored under keys that include the version of
+the data it was built from. Versions are named after what they cover:
+
+    'question:<id>'      a question, its tags, answers and comments
+    'answer:<id>'        a single answer and its comments
+    'questions'          listings of questions (index, tags, search)
+    'tags'               the tags themselves and their question counts
+    'tag:<id>'           the questions of a tag
+    'lists'              question lists (featured questions)
+    'feed:latest'        the latest questions feed
+    'feed:answers'       the all answers feed
+    'feed:answers:<id>'  the answers feed of a question
+    'feeds'              any other feed
+
+Saving or deleting any quanda model bumps the versions it affects (see the
+signal handlers at the bottom), so stale entries are simply never read again
+and expire on their own. Write paths hold those bumps back until they're
+done (see invalidate_after): a version bumped before the write commits would
+let a page still showing the old data be cached under the new version.
+
+Versions are the time of the change in microseconds, and double as the ETag
+of the pages built from them (see conditional_page).
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.http import HttpResponse
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import urlquote
+from django.views.decorators.http import condition
+
+from quanda.instrumentation import record_cache, section
+from quanda.models import Question, QuestionVote, QuestionTag, QuestionList, QuestionListOrder, Answer, AnswerVote, Comment
+
+PAGE_CACHING = getattr(settings, 'PAGE_CACHING', True)
+PAGE_CACHE_TIMEOUT = getattr(settings, 'PAGE_CACHE_TIMEOUT', 60 * 10)
+
+# versions have to outlive everything cached under them
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+_local = threading.local()
+
+def _version_key(name):
+    return 'quanda:version:%s' % name
+
+def _new_version():
+    # time based, so a version that fell out of the cache never comes back
+    # with a value some stale entry was stored under
+    return int(time.time() * 1000000)
+
+def get_versions(*names):
+    "Returns the current version of each name, in one cache round trip"
+    keys = [_version_key(name) for name in names]
+    found = cache.get_many(keys)
+    versions = []
+    for key in keys:
+        version = found.get(key)
+        if version is None:
+            version = _new_version()
+            cache.set(key, version, VERSION_TIMEOUT)
+        versions.append(version)
+    return versions
+
+def get_version(name):
+    return get_versions(name)[0]
+
+def invalidate(*names):
+    """
+    Bumps the given versions, orphaning everything cached under them. Inside
+    invalidate_after, only once the wrapped function returns.
+    """
+    pending = getattr(_local, 'pending', None)
+    if pending is not None:
+        pending.update(names)
+        return
+    for name in names:
+        cache.set(_version_key(name), _new_version(), VERSION_TIMEOUT)
+
+def invalidate_after(func):
+    """
+    Decorator holding back the invalidations made while func runs, including
+    the signal handlers', until it returns. Put it outside the transaction of
+    a write path, so versions are bumped after every counter it updates is
+    written and committed.
+    """
+    def wrapped(*args, **kwargs):
+        if getattr(_local, 'pending', None) is not None:
+            # an outer call will bump them
+            return func(*args, **kwargs)
+        _local.pending = set()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            names = _local.pending
+            _local.pending = None
+            invalidate(*names)
+    wrapped.__name__ = func.__name__
+    wrapped.__doc__ = func.__doc__
+    return wrapped
+
+def invalidate_question(question_id):
+    invalidate('question:%s' % question_id, 'questions')
+
+def versioned_key(prefix, names, *parts):
+    "Builds a cache key that changes whenever one of the named versions does"
+    versions = '.'.join([str(version) for version in get_versions(*names)])
+    parts = md5_constructor(':'.join([unicode(part) for part in parts])
+                            .encode('utf-8')).hexdigest()
+    return 'quanda:%s:%s:%s' % (prefix, parts, versions)
+
+def fragment_key(fragment_name, *vary_on):
+    "Returns the key django's {% cache %} tag stores a fragment under"
+    args = md5_constructor(u':'.join([urlquote(var) for var in vary_on]))
+    return 'template.cache.%s.%s' % (fragment_name, args.hexdigest())
+
+def cache_anonymous_page(prefix, get_version_names):
+    """
+    Decorator caching a view's whole response for anonymous GET requests.
+    get_version_names is called with the view's arguments and returns the
+    names of the versions the page depends on. Calls that pass an explicit
+    context (to show a message) are never cached.
+    """
+    def decorator(view):
+        def wrapped(request, *args, **kwargs):
+            if not PAGE_CACHING or request.method != 'GET' or \
+               request.user.is_authenticated() or kwargs.get('context'):
+                return view(request, *args, **kwargs)
+
+            with section('page_cache'):
+                key = versioned_key(prefix, get_version_names(*args, **kwargs),
+                                    request.get_full_path())
+                cached = cache.get(key)
+                record_cache(cached is not None)
+            if cached is not None:
+                content, content_type = cached
+                return HttpResponse(content, content_type=content_type)
+
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, (response.content, response['Content-Type']),
+                          PAGE_CACHE_TIMEOUT)
+            return response
+        wrapped.__name__ = view.__name__
+        wrapped.__doc__ = view.__doc__
+        return wrapped
+    return decorator
+
+def conditional_page(get_version_names):
+    """
+    Decorator answering conditional GETs with a 304 when none of the versions
+    the page depends on changed, without running the view. get_version_names
+    works as for cache_anonymous_page. The ETag covers the user, as pages
+    differ per user, and changes at least every PAGE_CACHE_TIMEOUT seconds:
+    view counts and rep shown on the page don't bump versions, and may only
+    lag as long as they do on cached pages. No Last-Modified is sent, its
+    one second resolution can't tell apart versions a few ms apart.
+    """
+    def get_page_versions(request, *args, **kwargs):
+        if request.method != 'GET' or kwargs.get('context'):
+            return None
+        if not hasattr(request, '_quanda_versions'):
+            request._quanda_versions = get_versions(*get_version_names(*args, **kwargs))
+        return request._quanda_versions
+
+    def etag(request, *args, **kwargs):
+        versions = get_page_versions(request, *args, **kwargs)
+        if versions is None:
+            return None
+        return md5_constructor('%s:%s:%s:%s' % (
+            '.'.join([str(version) for version in versions]),
+            int(time.time() / PAGE_CACHE_TIMEOUT),
+            request.user.id, request.get_full_path())).hexdigest()
+
+    return condition(etag_func=etag)
+
+# === Invalidation ===
+def question_changed(sender, instance, **kwargs):
+    invalidate('question:%s' % instance.id, 'questions', 'feeds',
+               'feed:latest', 'feed:answers:%s' % instance.id)
+
+def answer_changed(sender, instance, **kwargs):
+    invalidate('answer:%s' % instance.id,
+               'question:%s' % instance.question_id,
+               'questions', 'feeds', 'feed:answers',
+               'feed:answers:%s' % instance.question_id)
+
+def question_vote_changed(sender, instance, **kwargs):
+    invalidate_question(instance.question_id)
+
+def answer_vote_changed(sender, instance, **kwargs):
+    question_id = Answer.objects.filter(pk=instance.answer_id)\
+                  .values_list('question', flat=True)
+    invalidate('answer:%s' % instance.answer_id,
+               *['question:%s' % id for id in question_id])
+
+def comment_changed(sender, instance, **kwargs):
+    model = ContentType.objects.get_for_id(instance.content_type_id).model_class()
+    if model is Question:
+        invalidate('question:%s' % instance.object_id)
+    elif model is Answer:
+        question_id = Answer.objects.filter(pk=instance.object_id)\
+                      .values_list('question', flat=True)
+        invalidate('answer:%s' % instance.object_id,
+                   *['question:%s' % id for id in question_id])
+
+def tag_changed(sender, instance, **kwargs):
+    invalidate('tags', 'tag:%s' % instance.id, 'questions')
+
+def list_changed(sender, instance, **kwargs):
+    invalidate('lists')
+
+for model, handler in (
+        (Question, question_changed),
+        (Answer, answer_changed),
+        (QuestionVote, question_vote_changed),
+        (AnswerVote, answer_vote_changed),
+        (Comment, comment_changed),
+        (QuestionTag, tag_changed),
+        (QuestionList, list_changed),
+        (QuestionListOrder, list_changed)):
+    post_save.connect(handler, sender=model)
+    post_delete.connect(handler, sender=model)
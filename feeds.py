@@ -1,17 +1,28 @@
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
 from django.contrib.sites.models import Site
 from django.contrib.syndication.feeds import Feed
+from django.contrib.syndication.views import feed as syndication_feed
+from django.core.cache import cache
+from django.http import HttpResponse
 
+from quanda import caching
+from quanda.caching import PAGE_CACHE_TIMEOUT, conditional_page, versioned_key
+from quanda.instrumentation import record_cache, section
 from quanda.models import Question, Answer
+from quanda.pagination import paginate
+
+FEED_SIZE = getattr(settings, 'FEED_SIZE', 20)
 
 class RssQuestions(Feed):
     title_template = 'quanda-feeds/question-title.html'
     description_template = 'quanda-feeds/question-description.html'
     
-    def __init__(self, *args, **kwargs):
-        super(RssQuestions, self).__init__(*args, **kwargs)
-        self.site_name = Site.objects.get_current().name
+    @property
+    def site_name(self):
+        # looked up when the feed is generated, not each time it's served
+        return Site.objects.get_current().name
     
     def title(self):
         return u"Latest %s questions" % self.site_name
@@ -23,7 +34,7 @@ class RssQuestions(Feed):
         return reverse('quanda_index')
     
     def items(self):
-        return Question.objects.order_by("-posted")[:20]
+        return Question.objects.select_related('author').order_by("-posted")[:FEED_SIZE]
             
     def item_link(self, item):
         return item.get_absolute_url()
@@ -47,11 +58,71 @@ class RssAnswers(Feed):
         return reverse('quanda_index')
 
     def items(self, obj):
-        return Answer.objects.filter(question=obj).order_by('-posted')
+        # older answers are reached by following ?after=<cursor>
+        return paginate(Answer.objects.filter(question=obj)
+                        .select_related('author', 'question'),
+                        self.request.GET.get('after'),
+                        per_page=FEED_SIZE).object_list
 
     #def item_link(self, answer):
     #    return 'http://abc'
     #    return u"%s#%s" % (
     #        answer.question.get_absolute_url(),
     #        answer.id
-    #    )
\ No newline at end of file
+    #    )
+
+class RssAllAnswers(Feed):
+    "Every new answer on the site"
+    title_template = "quanda-feeds/answer-title.html"
+    description_template = "quanda-feeds/answer-description.html"
+
+    def title(self):
+        return u"Latest %s answers" % Site.objects.get_current().name
+
+    def description(self):
+        return u"Latest answers posted on %s" % Site.objects.get_current().name
+
+    def link(self):
+        return reverse('quanda_index')
+
+    def items(self):
+        return Answer.objects.select_related('author', 'question')\
+               .order_by('-posted', '-id')[:FEED_SIZE]
+
+def get_feed_versions(url, feed_dict=None):
+    """
+    Returns the names of the versions a feed depends on, so that a new answer
+    only regenerates the feeds it shows up in (see quanda.caching).
+    """
+    bits = url.split('/')
+    if bits[0] == 'latest':
+        return ['feed:latest']
+    elif bits[0] == 'answers' and len(bits) > 1:
+        return ['feed:answers:%s' % bits[1]]
+    elif bits[0] == 'all-answers':
+        return ['feed:answers']
+    return ['feeds']
+
+@conditional_page(get_feed_versions)
+def feed(request, url, feed_dict=None):
+    """
+    Django's syndication feed view, with the generated xml cached until the
+    questions or answers it shows change, and feed readers polling with
+    If-None-Match answered with a 304 until then.
+    """
+    if not caching.PAGE_CACHING:
+        return syndication_feed(request, url, feed_dict)
+
+    with section('feed_cache'):
+        key = versioned_key('feed', get_feed_versions(url), request.get_full_path())
+        cached = cache.get(key)
+        record_cache(cached is not None)
+    if cached is not None:
+        content, content_type = cached
+        return HttpResponse(content, content_type=content_type)
+
+    response = syndication_feed(request, url, feed_dict)
+    if response.status_code == 200:
+        cache.set(key, (response.content, response['Content-Type']),
+                  PAGE_CACHE_TIMEOUT)
+    return response
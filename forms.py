@@ -2,25 +2,43 @@ import datetime
 
 from django import forms
 from django.contrib.auth.models import User
+from django.db.models import F
 
+from quanda import leaderboards, routers, tags
+from quanda.caching import invalidate, invalidate_after
 from quanda.models import Question, QuestionList, QuestionListOrder, QuestionTag, Answer, Profile, Comment
-from quanda.utils import strip_js
+from quanda.related import update_related_questions
+from quanda.search import index_answer, index_question
+from quanda.utils import save_fields, strip_js
 
 class QuestionForm(forms.ModelForm):
     
-    tags = forms.ModelMultipleChoiceField(queryset=QuestionTag.objects.all(), widget=forms.CheckboxSelectMultiple, required=False)
+    tags = forms.CharField(required=False, help_text="comma separated",
+                           widget=forms.TextInput(attrs={'class': 'quanda_tags', 'autocomplete': 'off'}))
     
     class Meta:
         model = Question
-        exclude = ['author', 'posted', 'last_modified', 'view_count']
+        exclude = ['author', 'posted', 'last_modified', 'score', 'vote_count', 'view_count', 'answer_count', 'comment_count']
         
     def __init__(self, author, *args, **kwargs):
         super(QuestionForm, self).__init__(*args, **kwargs)
         self.author = author
         
+    def clean_tags(self):
+        "Turns the comma separated titles into the ids of existing tags"
+        titles = [title for title in self.cleaned_data['tags'].split(',')
+                  if title.strip()]
+        found = tags.get_tags(titles)
+        unknown = [title.strip() for title, tag in zip(titles, found) if tag is None]
+        if unknown:
+            raise forms.ValidationError("Unknown tag(s): %s" % ', '.join(unknown))
+        return [tag['id'] for tag in found]
+        
+    @invalidate_after
     def save(self, *args, **kwargs):
         kwargs['commit'] = False
         question = super(QuestionForm, self).save(*args, **kwargs)
+        is_new = question.pk is None
         
         if self.author.is_authenticated():
             question.author = self.author
@@ -30,14 +48,31 @@ class QuestionForm(forms.ModelForm):
         question.title = strip_js(question.title)
         question.question_text = strip_js(question.question_text)
         question.last_modified = datetime.datetime.now()
-        question.save()
-
-        if self.cleaned_data['tags']:
-            question.tags = []
-            for tag in self.cleaned_data['tags'].all():
-                question.tags.add(tag)
+        if is_new:
             question.save()
+        else:
+            save_fields(question, 'title', 'question_text', 'last_modified')
 
+        # as before, leaving the field empty leaves the tags alone
+        tag_ids = set(self.cleaned_data['tags'])
+        if is_new:
+            current_ids = set()
+        else:
+            current_ids = set(question.tags.values_list('id', flat=True))
+        if tag_ids and tag_ids != current_ids:
+            question.tags = QuestionTag.objects.filter(pk__in=tag_ids)
+            # changing a question's tags sends no signal for the cache
+            # invalidation to hear about (the question's own version was
+            # bumped by its save). 'tags' too, for the question counts of
+            # the tag directory.
+            invalidate('tags', *['tag:%s' % tag_id for tag_id in tag_ids ^ current_ids])
+            # relatedness only depends on the tags
+            update_related_questions(question)
+
+        index_question(question)
+        if is_new:
+            leaderboards.question_posted(question)
+        routers.user_wrote()
         return question
     
 class QuestionTagForm(forms.ModelForm):
@@ -63,7 +98,10 @@ class AnswerForm(forms.ModelForm):
         super(AnswerForm, self).__init__(*args, **kwargs)
         self.author = author
         self.question = question
+        # what the search index holds, so an edit only reindexes the change
+        self.indexed_text = self.instance.answer_text
         
+    @invalidate_after
     def save(self, *args, **kwargs):
         kwargs['commit'] = False
         answer = super(AnswerForm, self).save(*args, **kwargs)
@@ -73,10 +111,21 @@ class AnswerForm(forms.ModelForm):
         else:
             answer.author = User.objects.get(username='anonymous_user')
         
+        is_new = answer.pk is None
         answer.question = self.question
         answer.answer_text = strip_js(answer.answer_text)
         answer.last_modified = datetime.datetime.now()
-        answer.save()
+        if is_new:
+            answer.save()
+        else:
+            save_fields(answer, 'answer_text', 'last_modified')
+
+        if is_new:
+            Question.objects.filter(pk=self.question.pk)\
+                    .update(answer_count=F('answer_count') + 1)
+            leaderboards.question_answered(self.question.pk)
+        index_answer(self.question, self.indexed_text, answer.answer_text)
+        routers.user_wrote()
         return answer
     
     def clean(self):
@@ -92,7 +141,7 @@ class RepForm(forms.Form):
 class ProfileForm(forms.ModelForm):
     class Meta:
         model = Profile
-        exclude = ['user', 'reputation']
+        exclude = ['user', 'reputation', 'earned_reputation']
     
     def __init__(self, user, *args, **kwargs):
         super(ProfileForm, self).__init__(*args, **kwargs)
@@ -103,7 +152,8 @@ class ProfileForm(forms.ModelForm):
         profile = super(ProfileForm, self).save(*args, **kwargs)
         profile.bio = strip_js(profile.bio)
         profile.user = self.user
-        profile.save()
+        # leaves the rep alone, the ledger updates it concurrently
+        save_fields(profile, 'website', 'bio', 'location')
         return profile
 
 class QuestionListForm(forms.ModelForm):
@@ -0,0 +1,104 @@
+"""
+A request scoped identity map of users and their reputation.
+
+The same user can show up a dozen times on a page: as the author of the
+question, of answers, of comments, and in the header as the logged in user.
+Views prime the map with the ids of every user on the page, and the first
+lookup then loads all of them in one query; the rep template filter and
+author lookups are served from it afterwards.
+
+The map lives for the duration of a request, between the start() and end()
+calls of quanda.middleware.IdentityMapMiddleware. Without the middleware,
+each thread gets a map of its own, started afresh whenever a request starts
+so nothing stays stale longer than a request.
+"""
+
+import threading
+
+from django.contrib.auth.models import User
+from django.core.signals import request_started
+
+from quanda.reputation import get_users_rep
+
+_local = threading.local()
+
+class IdentityMap(object):
+    def __init__(self):
+        self.users = {}
+        self.user_ids = {}
+        self.reps = {}
+        self.pending_users = set()
+        self.pending_reps = set()
+
+    def prime(self, user_ids):
+        "Notes users about to be looked up, so they're loaded in one batch"
+        user_ids = set([user_id for user_id in user_ids if user_id is not None])
+        self.pending_users.update(user_ids - set(self.users))
+        self.pending_reps.update(user_ids - set(self.reps))
+
+    def add_users(self, users):
+        "Adds users already loaded by the view, so they're not looked up again"
+        for user in users:
+            if user is not None:
+                self.users[user.id] = user
+                self.user_ids[user.username] = user.id
+
+    def get_user_id(self, user):
+        "Returns the id of a user given as a User, an id or a username"
+        if not user:
+            return None
+        if isinstance(user, User):
+            return user.id
+        elif isinstance(user, (int, long)):
+            return user
+        if user not in self.user_ids:
+            ids = User.objects.filter(username=user).values_list('id', flat=True)
+            self.user_ids[user] = ids and ids[0] or None
+        return self.user_ids[user]
+
+    def get_user(self, user_id):
+        if user_id not in self.users:
+            user_ids = self.pending_users | set([user_id])
+            self.pending_users = set()
+            self.add_users(User.objects.in_bulk(list(user_ids)).values())
+        return self.users.get(user_id)
+
+    def get_rep(self, user_id):
+        if user_id not in self.reps:
+            user_ids = self.pending_reps | set([user_id])
+            self.pending_reps = set()
+            # users without a profile get theirs in the same batch
+            self.reps.update(get_users_rep(user_ids))
+            # unknown users have no rep
+            self.reps.setdefault(user_id, 0)
+        return self.reps[user_id]
+
+def start():
+    _local.map = IdentityMap()
+    return _local.map
+
+def end():
+    _local.map = None
+
+def current():
+    "Returns the identity map of the current request"
+    identity_map = getattr(_local, 'map', None)
+    if identity_map is None:
+        # no middleware: the thread's own map
+        identity_map = getattr(_local, 'fallback', None)
+        if identity_map is None:
+            identity_map = _local.fallback = IdentityMap()
+    return identity_map
+
+def request_starting(sender, **kwargs):
+    _local.fallback = None
+
+request_started.connect(request_starting)
+
+def get_rep(user):
+    "Returns the rep of a user, given as a User, an id or a username"
+    identity_map = current()
+    user_id = identity_map.get_user_id(user)
+    if user_id is None:
+        return 0
+    return identity_map.get_rep(user_id)
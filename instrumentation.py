@@ -0,0 +1,158 @@
+"""
+Per request instrumentation.
+
+Code that may be slow is wrapped in named sections:
+
+    with section('related_questions'):
+        ...
+
+or
+
+    @section('get_user_rep')
+    def get_user_rep(username): ...
+
+While a request is being instrumented (see
+quanda.middleware.InstrumentationMiddleware), each section records how many
+times it ran, its queries, the time spent in the database and in total, and
+the cache hits and misses reported from inside it. Sections are inclusive:
+queries run in a nested section also count for the outer one.
+
+The numbers of each request are logged, sent back as an X-Quanda-Sections
+header in debug mode, and added to process wide totals that staff can read
+at the stats view.
+"""
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.shortcuts import render_to_response as django_render_to_response
+
+INSTRUMENTATION = getattr(settings, 'INSTRUMENTATION', False)
+
+logger = logging.getLogger('quanda.instrumentation')
+
+_local = threading.local()
+_totals = {}
+_totals_lock = threading.Lock()
+
+class SectionStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.queries = 0
+        self.db_ms = 0.0
+        self.ms = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def add(self, other):
+        self.calls += other.calls
+        self.queries += other.queries
+        self.db_ms += other.db_ms
+        self.ms += other.ms
+        self.cache_hits += other.cache_hits
+        self.cache_misses += other.cache_misses
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'queries': self.queries,
+            'db_ms': round(self.db_ms, 3),
+            'ms': round(self.ms, 3),
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+        }
+
+class RequestStats(object):
+    "The sections recorded while handling one request"
+    def __init__(self):
+        self.sections = {}
+        self.open_sections = []
+
+    def get(self, name):
+        if name not in self.sections:
+            self.sections[name] = SectionStats()
+        return self.sections[name]
+
+def current():
+    "Returns the RequestStats of the request being instrumented, if any"
+    return getattr(_local, 'stats', None)
+
+def start_request():
+    _local.stats = RequestStats()
+    return _local.stats
+
+def end_request():
+    stats = current()
+    _local.stats = None
+    if stats is not None:
+        _totals_lock.acquire()
+        try:
+            for name, section_stats in stats.sections.items():
+                _totals.setdefault(name, SectionStats()).add(section_stats)
+        finally:
+            _totals_lock.release()
+    return stats
+
+def get_totals():
+    "Returns the process wide totals, as a dict of section name to dict"
+    _totals_lock.acquire()
+    try:
+        return dict([(name, stats.as_dict()) for name, stats in _totals.items()])
+    finally:
+        _totals_lock.release()
+
+def record_cache(hit):
+    "Counts a cache hit or miss against every open section"
+    stats = current()
+    if stats is None:
+        return
+    for name in stats.open_sections:
+        if hit:
+            stats.get(name).cache_hits += 1
+        else:
+            stats.get(name).cache_misses += 1
+
+class section(object):
+    "Context manager and decorator recording a named section of a request"
+
+    def __init__(self, name):
+        self.name = name
+        self.stats = None
+
+    def __enter__(self):
+        self.stats = current()
+        if self.stats is None:
+            return self
+        self.stats.open_sections.append(self.name)
+        self.first_query = len(connection.queries)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.stats is None:
+            return False
+        section_stats = self.stats.get(self.name)
+        section_stats.calls += 1
+        section_stats.ms += (time.time() - self.start) * 1000
+        queries = connection.queries[self.first_query:]
+        section_stats.queries += len(queries)
+        section_stats.db_ms += sum([float(query['time']) for query in queries]) * 1000
+        self.stats.open_sections.remove(self.name)
+        return False
+
+    def __call__(self, func):
+        name = self.name
+        def wrapped(*args, **kwargs):
+            with section(name):
+                return func(*args, **kwargs)
+        wrapped.__name__ = func.__name__
+        wrapped.__doc__ = func.__doc__
+        return wrapped
+
+def render_to_response(template_name, *args, **kwargs):
+    "django's render_to_response, recorded as a 'render:<template>' section"
+    with section('render:%s' % template_name):
+        return django_render_to_response(template_name, *args, **kwargs)
@@ -0,0 +1,116 @@
+"""
+The question lists shown on the index page, kept precomputed in the cache.
+
+Each board is a short ordered list of (question id, sort value) pairs,
+updated in place when a question is posted, voted on or answered, so reading
+one is a single cache get plus a single in_bulk query. A board missing from
+the cache is rebuilt from an indexed query, and every board is rebuilt at
+least every LEADERBOARD_TIMEOUT seconds to make up for concurrent updates.
+
+The 'hot' board ranks recent questions by score decayed with age and is
+simply recomputed every HOT_REFRESH seconds.
+"""
+
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+
+from quanda.instrumentation import record_cache, section
+from quanda.models import Question
+
+LEADERBOARD_SIZE = getattr(settings, 'LEADERBOARD_SIZE', 5)
+LEADERBOARD_TIMEOUT = getattr(settings, 'LEADERBOARD_TIMEOUT', 60 * 60)
+# hot questions are picked among the best scored questions of the last
+# HOT_WINDOW_DAYS days, their score divided by (age in hours + 2) ^ HOT_GRAVITY
+HOT_WINDOW_DAYS = getattr(settings, 'HOT_WINDOW_DAYS', 7)
+HOT_GRAVITY = getattr(settings, 'HOT_GRAVITY', 1.8)
+HOT_REFRESH = getattr(settings, 'HOT_REFRESH', 60 * 5)
+
+def _key(name):
+    return 'quanda:leaderboard:%s' % name
+
+def hot_rank(score, posted, now=None):
+    now = now or datetime.datetime.now()
+    delta = now - posted
+    age = delta.days * 24 + delta.seconds / 3600.0
+    return score / pow(max(age, 0) + 2, HOT_GRAVITY)
+
+def compute_board(name):
+    "Builds a board from the database"
+    if name == 'top':
+        rows = Question.objects.order_by('-score', '-id')\
+               .values_list('id', 'score')[:LEADERBOARD_SIZE]
+    elif name == 'recent':
+        rows = Question.objects.order_by('-posted', '-id')\
+               .values_list('id', 'posted')[:LEADERBOARD_SIZE]
+    elif name == 'unanswered':
+        rows = Question.objects.filter(answer_count=0)\
+               .order_by('-posted', '-id')\
+               .values_list('id', 'posted')[:LEADERBOARD_SIZE]
+    elif name == 'hot':
+        now = datetime.datetime.now()
+        since = now - datetime.timedelta(days=HOT_WINDOW_DAYS)
+        candidates = Question.objects.filter(posted__gte=since, score__gt=0)\
+                     .order_by('-score')\
+                     .values_list('id', 'score', 'posted')[:LEADERBOARD_SIZE * 10]
+        rows = [(id, hot_rank(score, posted, now))
+                for id, score, posted in candidates]
+        rows.sort(key=lambda row: -row[1])
+        rows = rows[:LEADERBOARD_SIZE]
+    else:
+        raise ValueError("Unknown leaderboard %s" % name)
+    return list(rows)
+
+def get_board(name):
+    board = cache.get(_key(name))
+    record_cache(board is not None)
+    if board is None:
+        board = compute_board(name)
+        set_board(name, board)
+    return board
+
+def set_board(name, board):
+    timeout = name == 'hot' and HOT_REFRESH or LEADERBOARD_TIMEOUT
+    cache.set(_key(name), board, timeout)
+
+@section('leaderboards')
+def get_questions(name):
+    "Returns the questions of a board, in order"
+    ids = [row[0] for row in get_board(name)]
+    questions = Question.objects.in_bulk(ids)
+    return [questions[id] for id in ids if id in questions]
+
+def question_posted(question):
+    "Puts a new question at the top of the recent and unanswered boards"
+    for name in ('recent', 'unanswered'):
+        board = [row for row in get_board(name) if row[0] != question.id]
+        board.insert(0, (question.id, question.posted))
+        set_board(name, board[:LEADERBOARD_SIZE])
+
+def question_scored(question):
+    """
+    Moves a question whose score changed within the top board. If a question
+    already on the board lost score, some question off the board may now
+    deserve its place, so the board is rebuilt instead.
+    """
+    board = get_board('top')
+    ids = [row[0] for row in board]
+    if question.id in ids:
+        if question.score < board[ids.index(question.id)][1]:
+            set_board('top', compute_board('top'))
+            return
+        board = [row for row in board if row[0] != question.id]
+    elif len(board) >= LEADERBOARD_SIZE and question.score <= board[-1][1]:
+        return
+
+    board.append((question.id, question.score))
+    board.sort(key=lambda row: (-row[1], -row[0]))
+    set_board('top', board[:LEADERBOARD_SIZE])
+
+def question_answered(question_id):
+    "Takes a question that just got its first answer off the unanswered board"
+    board = get_board('unanswered')
+    if question_id in [row[0] for row in board]:
+        # refill from the database rather than leave a hole
+        set_board('unanswered', compute_board('unanswered'))
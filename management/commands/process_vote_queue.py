@@ -0,0 +1,41 @@
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from quanda.votequeue import VOTE_QUEUE_BATCH_SIZE, apply_batch
+
+class Command(NoArgsCommand):
+    help = "Applies the votes queued when VOTE_WRITE_BEHIND is on, in " \
+           "batches. With --loop, keeps running and waits for new votes."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=VOTE_QUEUE_BATCH_SIZE,
+            help="Number of votes applied per transaction"),
+        make_option('--loop', action='store_true', dest='loop',
+            default=False,
+            help="Keep running, checking the queue every --interval seconds"),
+        make_option('--interval', action='store', dest='interval',
+            type='float', default=1.0,
+            help="Seconds to wait when the queue is empty, with --loop"),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options.get('batch_size')
+        verbosity = int(options.get('verbosity', 1))
+
+        applied = 0
+        while True:
+            count = apply_batch(batch_size)
+            applied += count
+            if verbosity >= 2 and count:
+                sys.stdout.write("%s vote(s) applied\n" % count)
+            if count < batch_size:
+                if not options.get('loop'):
+                    break
+                time.sleep(options.get('interval'))
+
+        if verbosity >= 1:
+            sys.stdout.write("%s vote(s) applied\n" % applied)
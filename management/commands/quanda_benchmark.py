@@ -0,0 +1,116 @@
+import datetime
+import sys
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connection
+from django.utils import simplejson
+
+from quanda import benchmark, caching, parallel
+
+class Command(NoArgsCommand):
+    help = "Seeds a throwaway test database with a synthetic corpus and " \
+           "benchmarks quanda's views against it."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--users', type='int', default=100),
+        make_option('--questions', type='int', default=1000),
+        make_option('--answers', type='int', default=3000),
+        make_option('--votes', type='int', default=20000),
+        make_option('--views', type='int', default=50000),
+        make_option('--tags', type='int', default=50),
+        make_option('--comments', type='int', default=5000),
+        make_option('--requests', type='int', default=200,
+            help="Number of requests per view"),
+        make_option('--only', action='append', default=[],
+            help="Only benchmark this view (can be repeated)"),
+        make_option('--seed', type='int', default=0,
+            help="Random seed, so runs are reproducible"),
+        make_option('--output', default=None,
+            help="Write the results as json to this file"),
+        make_option('--compare', default=None,
+            help="Compare with the results of a previous run"),
+        make_option('--no-cache', action='store_true', dest='no_cache',
+            default=False, help="Run without any caching"),
+        make_option('--db-latency', type='float', dest='db_latency', default=0,
+            help="Milliseconds added to every query, to simulate a remote database"),
+        make_option('--parallel', action='store_true', dest='parallel',
+            default=False,
+            help="Run the views with and without PARALLEL_QUERIES and compare"),
+    )
+
+    def handle_noargs(self, **options):
+        if options['parallel'] and settings.DATABASE_ENGINE == 'sqlite3' \
+           and not settings.TEST_DATABASE_NAME:
+            # each thread would get its own, empty, in memory database
+            raise CommandError("--parallel needs TEST_DATABASE_NAME set "
+                               "when using sqlite")
+
+        scale = dict([(key, options[key]) for key in (
+            'users', 'questions', 'answers', 'votes', 'views', 'tags',
+            'comments')])
+        old_page_caching = caching.PAGE_CACHING
+        caching.PAGE_CACHING = not options['no_cache']
+        old_parallel_queries = parallel.PARALLEL_QUERIES
+        try:
+            sync_results = None
+            if options['parallel']:
+                # both runs start from the same corpus and an empty cache
+                sync_results = self.measure(options, scale, False)
+                results = self.measure(options, scale, True)
+            else:
+                results = self.measure(options, scale, old_parallel_queries)
+            parallel_queries = parallel.PARALLEL_QUERIES
+        finally:
+            caching.PAGE_CACHING = old_page_caching
+            parallel.PARALLEL_QUERIES = old_parallel_queries
+
+        report = {
+            'date': datetime.datetime.now().isoformat(),
+            'scale': scale,
+            'requests': options['requests'],
+            'page_caching': not options['no_cache'],
+            'db_latency': options['db_latency'],
+            'parallel_queries': parallel_queries,
+            'results': results,
+        }
+        if sync_results is not None:
+            report['sync_results'] = sync_results
+        if options['output']:
+            output = open(options['output'], 'w')
+            simplejson.dump(report, output, indent=2, sort_keys=True)
+            output.close()
+
+        previous = {}
+        if options['compare']:
+            previous = simplejson.load(open(options['compare']))['results']
+        elif sync_results is not None:
+            sys.stdout.write("With PARALLEL_QUERIES, compared to without:\n")
+            previous = sync_results
+        for line in benchmark.compare(previous, results):
+            sys.stdout.write(line + '\n')
+
+    def measure(self, options, scale, parallel_queries):
+        """
+        Seeds a new test database and runs the views against it, in a new
+        cache, with PARALLEL_QUERIES set as given
+        """
+        # a cache of its own, so test database ids never reach the real one
+        restore_cache = benchmark.use_cache(options['no_cache'] and 'dummy://'
+                                            or 'locmem://')
+        old_name = settings.DATABASE_NAME
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            sys.stdout.write("Seeding...\n")
+            benchmark.seed(random_seed=options['seed'], **scale)
+
+            sys.stdout.write("Running%s...\n" % (
+                parallel_queries and " with PARALLEL_QUERIES" or ""))
+            parallel.PARALLEL_QUERIES = parallel_queries
+            return benchmark.run(options['requests'], options['only'],
+                                 random_seed=options['seed'],
+                                 db_latency=options['db_latency'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            restore_cache()
@@ -0,0 +1,53 @@
+import sys
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from django.contrib.contenttypes.models import ContentType
+
+from quanda.models import Question, QuestionVote, QuestionView, Answer, AnswerVote, Comment
+
+class Command(NoArgsCommand):
+    help = "Recalculates the stored score, vote, view, answer and comment " \
+           "counts of every question and answer."
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        scores = dict(QuestionVote.objects.values_list('question')
+                      .annotate(Sum('score')))
+        votes = dict(QuestionVote.objects.exclude(score=0)
+                     .values_list('question').annotate(Count('id')))
+        views = dict(QuestionView.objects.values_list('question')
+                     .annotate(Count('id')))
+        answers = dict(Answer.objects.values_list('question')
+                       .annotate(Count('id')))
+        comments = dict(Comment.objects
+                        .filter(content_type=ContentType.objects.get_for_model(Question))
+                        .values_list('object_id').annotate(Count('id')))
+
+        for question_id in Question.objects.values_list('id', flat=True):
+            Question.objects.filter(pk=question_id).update(
+                score=scores.get(question_id) or 0,
+                vote_count=votes.get(question_id, 0),
+                view_count=views.get(question_id, 0),
+                answer_count=answers.get(question_id, 0),
+                comment_count=comments.get(question_id, 0),
+            )
+
+        scores = dict(AnswerVote.objects.values_list('answer')
+                      .annotate(Sum('score')))
+        votes = dict(AnswerVote.objects.exclude(score=0)
+                     .values_list('answer').annotate(Count('id')))
+        comments = dict(Comment.objects
+                        .filter(content_type=ContentType.objects.get_for_model(Answer))
+                        .values_list('object_id').annotate(Count('id')))
+
+        for answer_id in Answer.objects.values_list('id', flat=True):
+            Answer.objects.filter(pk=answer_id).update(
+                score=scores.get(answer_id) or 0,
+                vote_count=votes.get(answer_id, 0),
+                comment_count=comments.get(answer_id, 0),
+            )
+
+        sys.stdout.write("Counters rebuilt\n")
@@ -0,0 +1,14 @@
+import sys
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from quanda.related import rebuild_related_questions
+
+class Command(NoArgsCommand):
+    help = "Recomputes the related questions list of every question."
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        count = rebuild_related_questions()
+        sys.stdout.write("Related questions of %s question(s) rebuilt\n" % count)
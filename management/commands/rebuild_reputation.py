@@ -0,0 +1,42 @@
+import sys
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import NoArgsCommand
+
+from quanda.models import Profile
+from quanda.reputation import compute_earned_reputation, rebuild_user_ledger
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the reputation ledger from the vote tables, or with " \
+           "--verify, checks that the stored reputation matches them."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--verify', action='store_true', dest='verify',
+            default=False,
+            help="Only report users whose stored rep is wrong, don't fix it"),
+    )
+
+    def handle_noargs(self, **options):
+        verify = options.get('verify')
+        verbosity = int(options.get('verbosity', 1))
+
+        stored = dict(Profile.objects.values_list('user', 'earned_reputation'))
+
+        mismatches = 0
+        for user in User.objects.order_by('id').iterator():
+            if verify:
+                expected = compute_earned_reputation(user)
+            else:
+                expected = rebuild_user_ledger(user)
+
+            if stored.get(user.id, 0) != expected:
+                mismatches += 1
+                if verbosity >= 1:
+                    sys.stdout.write("%s: stored %s, expected %s\n" % (
+                        user.username, stored.get(user.id, 0), expected))
+
+        if verify:
+            sys.stdout.write("%s user(s) with a wrong reputation\n" % mismatches)
+        else:
+            sys.stdout.write("Ledger rebuilt, %s user(s) corrected\n" % mismatches)
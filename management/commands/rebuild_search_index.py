@@ -0,0 +1,15 @@
+import sys
+
+from django.core.management.base import NoArgsCommand
+
+from quanda.models import SearchDocument, SearchTerm
+from quanda.search import rebuild_index
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the full text search index of all questions and answers."
+
+    def handle_noargs(self, **options):
+        SearchTerm.objects.all().delete()
+        SearchDocument.objects.all().delete()
+        count = rebuild_index()
+        sys.stdout.write("%s question(s) indexed\n" % count)
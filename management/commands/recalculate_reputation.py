@@ -0,0 +1,72 @@
+import sys
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+from django.db.models import Max, Min
+
+from quanda.reputation import recalculate_range
+
+def recalculate_chunk(args):
+    "Runs one chunk in its own transaction; also the entry point of workers"
+    first_user_id, last_user_id, dry_run = args
+    # forked workers must not share the parent's database connection
+    connection.close()
+    return transaction.commit_on_success(recalculate_range)(
+        first_user_id, last_user_id, dry_run)
+
+class Command(NoArgsCommand):
+    help = "Recalculates every user's earned reputation with grouped queries " \
+           "over chunks of user ids and writes the corrections in bulk. Much " \
+           "faster than rebuild_reputation on large sites, and only books " \
+           "correcting events instead of rewriting the ledger."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', action='store', dest='chunk_size',
+            type='int', default=10000,
+            help="Number of user ids handled per query and transaction"),
+        make_option('--workers', action='store', dest='workers',
+            type='int', default=1,
+            help="Number of processes recalculating chunks in parallel"),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False,
+            help="Only report users whose stored rep is wrong, don't fix it"),
+    )
+
+    def handle_noargs(self, **options):
+        chunk_size = options.get('chunk_size')
+        workers = options.get('workers')
+        dry_run = options.get('dry_run')
+        verbosity = int(options.get('verbosity', 1))
+
+        bounds = User.objects.aggregate(first=Min('id'), last=Max('id'))
+        if bounds['first'] is None:
+            return
+        chunks = [(start, start + chunk_size - 1, dry_run) for start in
+                  range(bounds['first'], bounds['last'] + 1, chunk_size)]
+
+        if workers > 1:
+            from multiprocessing import Pool
+            connection.close()
+            pool = Pool(workers)
+            results = pool.imap(recalculate_chunk, chunks)
+        else:
+            pool = None
+            results = (recalculate_chunk(chunk) for chunk in chunks)
+
+        corrected = 0
+        for changes in results:
+            corrected += len(changes)
+            if verbosity >= 1:
+                for user_id, before, after in changes:
+                    sys.stdout.write("user %s: stored %s, expected %s\n" % (
+                        user_id, before is None and 'nothing' or before, after))
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        if dry_run:
+            sys.stdout.write("%s user(s) with a wrong reputation\n" % corrected)
+        else:
+            sys.stdout.write("Reputation recalculated, %s user(s) corrected\n" % corrected)
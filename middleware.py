@@ -0,0 +1,80 @@
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from quanda import identity, instrumentation, routers
+
+class IdentityMapMiddleware(object):
+    """
+    Gives each request its own identity map of users and their rep (see
+    quanda.identity), so a user shown several times on a page is only looked
+    up once.
+    """
+
+    def process_request(self, request):
+        identity.start()
+        return None
+
+    def process_response(self, request, response):
+        identity.end()
+        return response
+
+class ReplicaMiddleware(object):
+    """
+    Sends the reads of POST requests, and of users who wrote recently, to the
+    primary database rather than to a replica (see quanda.routers).
+    """
+
+    def process_request(self, request):
+        routers.start(use_primary=request.method == 'POST' or
+                      routers.is_sticky(request))
+        return None
+
+    def process_response(self, request, response):
+        if routers.end():
+            seconds = routers.REPLICA_STICKY_SECONDS
+            response.set_cookie(routers.REPLICA_STICKY_COOKIE,
+                                '%.0f' % (time.time() + seconds), max_age=seconds)
+        return response
+
+class InstrumentationMiddleware(object):
+    """
+    Records quanda's instrumentation sections for each request when the
+    INSTRUMENTATION setting is on (see quanda.instrumentation). Add it to
+    MIDDLEWARE_CLASSES, as early as possible.
+    """
+
+    def process_request(self, request):
+        if not instrumentation.INSTRUMENTATION:
+            return None
+        # have queries logged even when DEBUG is off (django 1.2+)
+        connection.use_debug_cursor = True
+        instrumentation.start_request()
+        request._quanda_started = time.time()
+        return None
+
+    def process_response(self, request, response):
+        stats = instrumentation.end_request()
+        if stats is None:
+            return response
+
+        total_ms = (time.time() - request._quanda_started) * 1000
+        sections = sorted(stats.sections.items())
+
+        instrumentation.logger.info('path=%s status=%s total_ms=%.1f %s' % (
+            request.path, response.status_code, total_ms,
+            ' '.join(['section=%s calls=%s queries=%s db_ms=%.1f ms=%.1f '
+                      'cache_hits=%s cache_misses=%s' % (
+                          name, s.calls, s.queries, s.db_ms, s.ms,
+                          s.cache_hits, s.cache_misses)
+                      for name, s in sections])))
+
+        if settings.DEBUG:
+            response['X-Quanda-Time'] = '%.1f' % total_ms
+            response['X-Quanda-Sections'] = ', '.join([
+                '%s;calls=%s;queries=%s;db=%.1f;time=%.1f;hits=%s;misses=%s' % (
+                    name, s.calls, s.queries, s.db_ms, s.ms,
+                    s.cache_hits, s.cache_misses)
+                for name, s in sections])
+        return response
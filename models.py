@@ -6,7 +6,7 @@ from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.template.defaultfilters import slugify
 
 #def get_posted_date(obj):
@@ -21,9 +21,12 @@ class Profile(models.Model):
     """A user using the Quanda system. This can be an anonymous user."""
     user = models.OneToOneField(User)
     
-    # Since rep is calculated dynamically, this represents reputation awarded
-    # outside the regular rep process (say by an admin)
+    # Reputation awarded outside the regular rep process (say by an admin)
     reputation = models.IntegerField(default=0)
+    # Running total of the rep earned through votes on the user's posts. This
+    # is kept up to date by the reputation ledger (see quanda.reputation) so
+    # that it never has to be recalculated from the vote tables on reads.
+    earned_reputation = models.IntegerField(default=0)
     website = models.CharField(max_length=140, blank=True)
     bio = models.TextField(blank=True)
     location = models.CharField(max_length=140, blank=True)
@@ -33,26 +36,82 @@ class Profile(models.Model):
 
 class QuestionManager(models.Manager): pass
 
+class VoteConflict(Exception):
+    "Raised when a vote kept losing races against concurrent votes"
+
+class VoteManager(models.Manager):
+    # attempts at setting a vote before giving up
+    SET_VOTE_ATTEMPTS = 3
+
+    def set_vote(self, user, score, **target):
+        """
+        Sets the user's vote on a target (question=... or answer=...) to score
+        and returns (vote, previous score), previous score being 0 for a new
+        vote. Safe against concurrent votes by the same user: the insert
+        relies on the unique (user, target) index and the update only applies
+        if the score is still the one that was read. Each attempt runs in a
+        savepoint; VoteConflict is raised after SET_VOTE_ATTEMPTS lost races
+        (under REPEATABLE READ, retrying in the same transaction can't see
+        the concurrent vote). Has to run inside a transaction.
+        """
+        for attempt in range(self.SET_VOTE_ATTEMPTS):
+            sid = transaction.savepoint()
+            try:
+                result = self._try_set_vote(user, score, **target)
+            except IntegrityError:
+                # a concurrent request created it first, update it instead
+                result = None
+            if result is None:
+                transaction.savepoint_rollback(sid)
+                continue
+            transaction.savepoint_commit(sid)
+            return result
+        raise VoteConflict("%s's vote on %s kept conflicting" % (user, target))
+
+    def _try_set_vote(self, user, score, **target):
+        "One attempt of set_vote, returns None if it lost a race"
+        try:
+            vote = self.get(user=user, **target)
+        except self.model.DoesNotExist:
+            return self.create(user=user, score=score, **target), 0
+
+        previous_score = vote.score
+        if previous_score == score:
+            return vote, previous_score
+        if not self.filter(pk=vote.pk, score=previous_score).update(score=score):
+            return None
+        vote.score = score
+        # update() doesn't send post_save, but listeners (such as the cache
+        # invalidation) need to hear about the change
+        models.signals.post_save.send(sender=self.model,
+                                      instance=vote, created=False)
+        return vote, previous_score
+
 class Question(models.Model):
     title = models.CharField(max_length=140)
     question_text = models.TextField(blank=True)
     
-    posted = models.DateTimeField(default=datetime.datetime.now)
+    posted = models.DateTimeField(default=datetime.datetime.now, db_index=True)
     last_modified = models.DateTimeField(default=datetime.datetime.now)
     author = models.ForeignKey(User, blank=True, null=True)
     
+    # denormalized counters, kept up to date by the views that change them
+    # (see quanda.utils.adjust_vote_counters)
+    score = models.IntegerField(default=0, db_index=True)
+    vote_count = models.IntegerField(default=0)
+    view_count = models.IntegerField(default=0)
+    answer_count = models.IntegerField(default=0, db_index=True)
+    comment_count = models.IntegerField(default=0)
+    
     #get_posted_date = get_posted_date
     objects = QuestionManager()
     comments = generic.GenericRelation('Comment')
     
     def get_view_count(self):
-        return QuestionView.objects.filter(question=self).count()
+        return self.view_count
     
     def get_score(self):
-        score = 0
-        for question_vote in QuestionVote.objects.filter(question=self):
-            score += question_vote.score
-        return score
+        return self.score
     
     def get_absolute_url(self):
         return "%s%s/" % (
@@ -77,6 +136,11 @@ class QuestionVote(models.Model):
     user = models.ForeignKey(User)
     question = models.ForeignKey(Question, related_name='questionvotes')
     score = models.IntegerField(default=0)
+
+    objects = VoteManager()
+
+    class Meta:
+        unique_together = (('user', 'question'),)
     
 class QuestionView(models.Model):
     question = models.ForeignKey(Question, related_name='questionviews')
@@ -94,6 +158,20 @@ class QuestionTag(models.Model):
     class Meta:
         ordering = ('title',)
 
+class RelatedQuestion(models.Model):
+    """
+    An entry of a question's precomputed list of related questions. The
+    score is the sum of the weights of the tags both questions share, rarer
+    tags weighing more (see quanda.related).
+    """
+    question = models.ForeignKey(Question, related_name='related_entries')
+    related = models.ForeignKey(Question, related_name='related_to_entries')
+    score = models.FloatField(default=0)
+
+    class Meta:
+        ordering = ('-score',)
+        unique_together = (('question', 'related'),)
+
 class QuestionList(models.Model):
     title = models.CharField(max_length=140, unique=True)
     questions = models.ManyToManyField(Question, through='QuestionListOrder', related_name='lists')
@@ -108,11 +186,15 @@ class Answer(models.Model):
     question = models.ForeignKey(Question, related_name='answers')    
     answer_text = models.TextField()
 
-    posted = models.DateTimeField(default=datetime.datetime.now)
+    posted = models.DateTimeField(default=datetime.datetime.now, db_index=True)
     last_modified = models.DateTimeField(default=datetime.datetime.now)
     author = models.ForeignKey(User)
     user_chosen = models.BooleanField(default=False)
 
+    score = models.IntegerField(default=0, db_index=True)
+    vote_count = models.IntegerField(default=0)
+    comment_count = models.IntegerField(default=0)
+
     comments = generic.GenericRelation('Comment')
     
     #get_posted_date = get_posted_date
@@ -125,10 +207,7 @@ class Answer(models.Model):
         self.user_prev_vote = 0
     
     def get_score(self):
-        score = 0
-        for answer_vote in AnswerVote.objects.filter(answer=self):
-            score += answer_vote.score
-        return score
+        return self.score
     
     def get_absolute_url(self):
         return u"%s#answer_%s" % (
@@ -144,10 +223,62 @@ class AnswerVote(models.Model):
     answer = models.ForeignKey(Answer, related_name='answervotes')
     score = models.IntegerField(default=0)
 
+    objects = VoteManager()
+
+    class Meta:
+        unique_together = (('user', 'answer'),)
+
+class PendingVote(models.Model):
+    """
+    A vote accepted but not applied yet, when votes are written behind (see
+    quanda.votequeue). Only the user's latest vote on a target is kept.
+    """
+    user = models.ForeignKey(User)
+    question = models.ForeignKey(Question, blank=True, null=True)
+    answer = models.ForeignKey(Answer, blank=True, null=True)
+    score = models.IntegerField(default=0)
+    queued = models.DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        unique_together = (('user', 'question'), ('user', 'answer'))
+
+class ReputationEvent(models.Model):
+    """
+    One entry of the reputation ledger: the rep a user gained or lost because
+    a vote on one of their posts was cast, changed or retracted. The sum of a
+    user's events always equals their profile's earned_reputation.
+    """
+    user = models.ForeignKey(User, related_name='reputation_events')
+    points = models.IntegerField()
+    question_vote = models.ForeignKey(QuestionVote, blank=True, null=True)
+    answer_vote = models.ForeignKey(AnswerVote, blank=True, null=True)
+    created = models.DateTimeField(default=datetime.datetime.now)
+
+    def __unicode__(self):
+        return u"%+d for %s" % (self.points, self.user)
+
+class SearchDocument(models.Model):
+    """
+    A question as seen by the search index: its title, text, tags and the
+    text of its answers. length is the weighted number of terms it holds.
+    """
+    question = models.OneToOneField(Question, related_name='search_document')
+    length = models.IntegerField(default=0)
+    indexed = models.DateTimeField(default=datetime.datetime.now)
+
+class SearchTerm(models.Model):
+    """A posting of the inverted index: how often a term appears in a question"""
+    term = models.CharField(max_length=40, db_index=True)
+    question = models.ForeignKey(Question, related_name='search_terms')
+    frequency = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('term', 'question'),)
+
 class Comment(models.Model):
     user = models.ForeignKey(User)
     comment_text = models.TextField(blank=False)
-    posted = models.DateTimeField(default=datetime.datetime.now())
+    posted = models.DateTimeField(default=datetime.datetime.now, db_index=True)
     ip = models.CharField(max_length=40, blank=False)
     
     content_type = models.ForeignKey(ContentType)
@@ -156,3 +287,7 @@ class Comment(models.Model):
 
     class Meta:
         ordering = ['posted']
+
+# connect the signal handlers of the cache invalidation and related questions
+import quanda.caching
+import quanda.related
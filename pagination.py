@@ -0,0 +1,141 @@
+"""
+Keyset (cursor) pagination.
+
+Instead of an OFFSET, each page ends with a cursor holding the sort values
+of its last item, and the next page is fetched with a WHERE clause starting
+right after those values. Every page, however deep, costs the same indexed
+lookup as the first one, and pages don't shift when new items are posted.
+"""
+
+import base64
+import datetime
+
+from django.conf import settings
+from django.db import models
+from django.db.models import Q
+
+LISTING_PAGE_SIZE = getattr(settings, 'LISTING_PAGE_SIZE', 20)
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+class InvalidCursor(Exception): pass
+
+class CursorPage(object):
+    def __init__(self, object_list, next_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+def encode_cursor(values):
+    parts = []
+    for value in values:
+        if isinstance(value, datetime.datetime):
+            parts.append(value.strftime(DATETIME_FORMAT))
+        elif isinstance(value, bool):
+            parts.append(str(int(value)))
+        else:
+            parts.append(repr(value))
+    return base64.urlsafe_b64encode('|'.join(parts))
+
+def decode_cursor(cursor, types):
+    """
+    Turns a cursor back into its values, given the type of each value.
+    Raises InvalidCursor for anything that isn't a cursor we generated.
+    """
+    try:
+        parts = base64.urlsafe_b64decode(str(cursor)).split('|')
+        if len(parts) != len(types):
+            raise ValueError
+        values = []
+        for part, type in zip(parts, types):
+            if type is datetime.datetime:
+                values.append(datetime.datetime.strptime(part, DATETIME_FORMAT))
+            else:
+                values.append(type(part.rstrip('L')))
+        return values
+    except (TypeError, ValueError):
+        raise InvalidCursor(cursor)
+
+def _decode_bool(value):
+    return bool(int(value))
+
+def _field_type(model, name):
+    field = model._meta.get_field(name)
+    if isinstance(field, models.DateTimeField):
+        return datetime.datetime
+    elif isinstance(field, models.FloatField):
+        return float
+    elif isinstance(field, models.BooleanField):
+        return _decode_bool
+    return int
+
+def keyset_filter(fields, values, descending):
+    """
+    Returns the Q object selecting the rows that come after `values` when
+    ordering on `fields`: for (posted, id) descending, that's
+    posted < p OR (posted = p AND id < i).
+    """
+    lookup = descending and 'lt' or 'gt'
+    condition = None
+    for i in range(len(fields)):
+        lookups = dict([(fields[j], values[j]) for j in range(i)])
+        lookups['%s__%s' % (fields[i], lookup)] = values[i]
+        if condition is None:
+            condition = Q(**lookups)
+        else:
+            condition |= Q(**lookups)
+    return condition
+
+def paginate(queryset, cursor=None, fields=('posted', 'id'), descending=True,
+             per_page=LISTING_PAGE_SIZE):
+    """
+    Returns the CursorPage of queryset following `cursor` (the first page if
+    cursor is empty or invalid). The fields must make a unique ordering,
+    which is why they end with the id.
+    """
+    queryset = queryset.order_by(*[(descending and '-' or '') + field
+                                   for field in fields])
+    if cursor:
+        types = [_field_type(queryset.model, field) for field in fields]
+        try:
+            values = decode_cursor(cursor, types)
+        except InvalidCursor:
+            pass
+        else:
+            queryset = queryset.filter(keyset_filter(fields, values, descending))
+
+    items = list(queryset[:per_page + 1])
+    next_cursor = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        next_cursor = encode_cursor([getattr(items[-1], field)
+                                     for field in fields])
+    return CursorPage(items, next_cursor)
+
+def paginate_ranked(ranked, cursor=None, per_page=LISTING_PAGE_SIZE):
+    """
+    Same as paginate, for a list of (id, score) pairs already sorted by
+    score then id, both descending (such as search results).
+    """
+    if cursor:
+        try:
+            score, id = decode_cursor(cursor, (float, int))
+        except InvalidCursor:
+            pass
+        else:
+            ranked = [row for row in ranked
+                      if (row[1], row[0]) < (score, id)]
+
+    next_cursor = None
+    if len(ranked) > per_page:
+        ranked = ranked[:per_page]
+        next_cursor = encode_cursor([float(ranked[-1][1]), ranked[-1][0]])
+    return CursorPage(ranked, next_cursor)
@@ -0,0 +1,113 @@
+"""
+Running a page's independent queries concurrently.
+
+With PARALLEL_QUERIES on, fetch() hands the lookups it's given to a pool of
+PARALLEL_WORKERS threads and waits for all of them, so a page making five
+independent queries waits for the slowest rather than for their sum. Each
+worker has its own database connections (django's connections are per
+thread), all closed after each lookup, so it reads what's committed like the
+request would and doesn't hold a connection while idle.
+
+Only use it for reads: the workers don't see the request's uncommitted
+writes. They read from the same database (primary or replica, see
+quanda.routers) as the request would. Their queries aren't counted by
+quanda.instrumentation either.
+"""
+
+import sys
+import threading
+import Queue
+
+from django.conf import settings
+from django.db import connection, transaction
+try:
+    from django.db import connections
+except ImportError:
+    # django 1.1 has a single database
+    connections = None
+
+from quanda import routers
+
+PARALLEL_QUERIES = getattr(settings, 'PARALLEL_QUERIES', False)
+PARALLEL_WORKERS = getattr(settings, 'PARALLEL_WORKERS', 4)
+
+_tasks = Queue.Queue()
+_workers = []
+_workers_lock = threading.Lock()
+
+class Task(object):
+    def __init__(self, func):
+        self.func = func
+        self.result = None
+        self.exc_info = None
+        self.done = threading.Event()
+        self.use_primary = routers.use_primary()
+
+    def run(self):
+        routers.set_use_primary(self.use_primary)
+        try:
+            self.result = self.func()
+        except:
+            self.exc_info = sys.exc_info()
+        if connections is None:
+            used = [connection]
+        else:
+            # the lookup may have read the primary and any replica
+            used = connections.all()
+        for used_connection in used:
+            try:
+                if connections is None:
+                    transaction.rollback_unless_managed()
+                else:
+                    transaction.rollback_unless_managed(using=used_connection.alias)
+                used_connection.close()
+            except Exception:
+                pass
+        self.done.set()
+
+if sys.version_info[0] < 3:
+    # the three argument raise, keeping the worker's traceback, is only
+    # valid syntax in python 2
+    exec("def _reraise(exc_type, exc_value, tb):\n"
+         "    raise exc_type, exc_value, tb\n")
+else:
+    def _reraise(exc_type, exc_value, tb):
+        raise exc_value.with_traceback(tb)
+
+def _work():
+    while True:
+        _tasks.get().run()
+
+def _start_workers():
+    _workers_lock.acquire()
+    try:
+        while len(_workers) < PARALLEL_WORKERS:
+            worker = threading.Thread(target=_work)
+            worker.setDaemon(True)
+            worker.start()
+            _workers.append(worker)
+    finally:
+        _workers_lock.release()
+
+def fetch(**lookups):
+    """
+    Calls every lookup (a function without arguments) and returns a dict of
+    their results by name. With PARALLEL_QUERIES on they run concurrently,
+    otherwise one after the other in the calling thread. The first error
+    raised by a lookup is raised again here.
+    """
+    if not PARALLEL_QUERIES or len(lookups) < 2:
+        return dict([(name, lookup()) for name, lookup in lookups.items()])
+
+    _start_workers()
+    tasks = dict([(name, Task(lookup)) for name, lookup in lookups.items()])
+    for task in tasks.values():
+        _tasks.put(task)
+
+    results = {}
+    for name, task in tasks.items():
+        task.done.wait()
+        if task.exc_info:
+            _reraise(*task.exc_info)
+        results[name] = task.result
+    return results
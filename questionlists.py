@@ -0,0 +1,81 @@
+"""
+Ordering of the questions in a question list.
+
+Order keys are spaced ORDER_GAP apart, so moving a question between two
+others is a matter of giving it a key in between: the rest of the list is
+left alone. Keys are only spread out again, in the same transaction, when a
+move leaves two of them without room in between.
+"""
+
+from django.db import connection, transaction
+from django.db.models import Max
+
+from quanda.caching import invalidate, invalidate_after
+from quanda.models import QuestionListOrder
+
+ORDER_GAP = 1024
+
+class InvalidOrder(Exception): pass
+
+def append(question_list, question):
+    "Adds a question at the end of the list"
+    last = QuestionListOrder.objects.filter(question_list=question_list)\
+           .aggregate(last=Max('order'))['last']
+    return QuestionListOrder.objects.create(question_list=question_list,
+                                            question=question,
+                                            order=(last or 0) + ORDER_GAP)
+
+def _bulk_set_orders(orders):
+    "Sets the order key of many items with a single UPDATE"
+    if not orders:
+        return
+    qn = connection.ops.quote_name
+    meta = QuestionListOrder._meta
+    items = orders.items()
+    connection.cursor().execute(
+        "UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)" % (
+            qn(meta.db_table), qn('order'), qn('id'),
+            ' '.join(['WHEN %s THEN %s'] * len(items)),
+            qn('id'), ', '.join(['%s'] * len(items))),
+        sum([[id, order] for id, order in items], []) + [id for id, order in items])
+    transaction.set_dirty()
+
+@invalidate_after
+@transaction.commit_on_success
+def reorder(question_list, new_orders):
+    """
+    Applies {question id: order key} to the list, in one transaction: a key
+    of 0 removes the question from the list, other keys must be unique
+    within the list (InvalidOrder is raised otherwise). Only the items whose
+    key changed are written, with one UPDATE.
+    """
+    items = dict([(question_id, (id, order)) for id, question_id, order in
+                  QuestionListOrder.objects.filter(question_list=question_list)
+                  .values_list('id', 'question', 'order')])
+    new_orders = dict([(question_id, order) for question_id, order
+                       in new_orders.items() if question_id in items])
+
+    removed = [question_id for question_id, order in new_orders.items() if order == 0]
+    orders = dict([(question_id, order) for question_id, (id, order) in items.items()
+                   if question_id not in removed])
+    orders.update([(question_id, order) for question_id, order in new_orders.items()
+                   if order != 0])
+    if len(set(orders.values())) != len(orders):
+        raise InvalidOrder
+
+    if removed:
+        QuestionListOrder.objects.filter(question_list=question_list,
+                                         question__in=removed).delete()
+
+    keys = sorted(orders.values())
+    if min([keys[i] - keys[i - 1] for i in range(1, len(keys))] or [ORDER_GAP]) < 2:
+        # no room left between some keys: spread the whole list out again
+        ranked = sorted(orders.items(), key=lambda item: item[1])
+        orders = dict([(question_id, (i + 1) * ORDER_GAP)
+                       for i, (question_id, order) in enumerate(ranked)])
+
+    _bulk_set_orders(dict([(items[question_id][0], order)
+                           for question_id, order in orders.items()
+                           if order != items[question_id][1]]))
+    # the raw update sends no signal
+    invalidate('lists')
@@ -0,0 +1,153 @@
+"""
+Precomputed related questions.
+
+Two questions are related when they share tags. Each shared tag adds its
+inverse frequency to the pair's score, so sharing a rare tag counts for more
+than sharing a tag half the site uses. Every question keeps its top
+RELATED_QUESTIONS_COUNT related questions in the RelatedQuestion table, which
+is refreshed when the question's tags change, or when a question it lists
+is deleted.
+"""
+
+import math
+
+from django.conf import settings
+from django.db.models import Count
+from django.db.models.signals import pre_delete, post_delete
+
+from quanda.caching import invalidate
+from quanda.instrumentation import section
+from quanda.models import Question, QuestionTag, RelatedQuestion
+
+RELATED_QUESTIONS_COUNT = getattr(settings, 'RELATED_QUESTIONS_COUNT', 10)
+RELATED_CANDIDATES_LIMIT = getattr(settings, 'RELATED_CANDIDATES_LIMIT', 1000)
+
+def get_tag_weights(tag_ids):
+    "Returns a dict of tag id to the tag's inverse question frequency"
+    question_count = Question.objects.count() or 1
+    return dict([(tag_id, math.log(float(question_count + 1) / (count + 1)) + 1)
+                 for tag_id, count in QuestionTag.objects.filter(id__in=tag_ids)
+                 .annotate(count=Count('questions')).values_list('id', 'count')])
+
+def score_related(question, tag_ids=None):
+    """
+    Returns a dict of question id to relatedness score for the questions
+    sharing at least one tag with `question`. Only the newest
+    RELATED_CANDIDATES_LIMIT questions of each tag are looked at, so a tag
+    half the site uses doesn't mean scanning half the site.
+    """
+    if tag_ids is None:
+        tag_ids = list(question.tags.values_list('id', flat=True))
+    if not tag_ids:
+        return {}
+
+    weights = get_tag_weights(tag_ids)
+    scores = {}
+    for tag_id in tag_ids:
+        for question_id in Question.objects.filter(tags=tag_id).order_by('-id')\
+                           .values_list('id', flat=True)[:RELATED_CANDIDATES_LIMIT]:
+            if question_id == question.id:
+                continue
+            scores[question_id] = scores.get(question_id, 0) + weights.get(tag_id, 0)
+    return scores
+
+def top_scores(scores, count=RELATED_QUESTIONS_COUNT):
+    "Returns the (question id, score) pairs with the highest scores"
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+    return ranked[:count]
+
+def set_related(question, ranked):
+    RelatedQuestion.objects.filter(question=question).delete()
+    for related_id, score in ranked:
+        RelatedQuestion.objects.create(question=question,
+                                       related_id=related_id, score=score)
+
+def add_related(question_id, related_id, score):
+    """
+    Puts related_id in question_id's list if it beats the entries already
+    there, then trims the list back to RELATED_QUESTIONS_COUNT. Returns
+    whether the list changed.
+    """
+    entries = list(RelatedQuestion.objects.filter(question=question_id))
+    for entry in entries:
+        if entry.related_id == related_id:
+            if entry.score == score:
+                return False
+            entry.score = score
+            entry.save()
+            return True
+    if len(entries) >= RELATED_QUESTIONS_COUNT and entries[-1].score >= score:
+        return False
+
+    RelatedQuestion.objects.create(question_id=question_id,
+                                   related_id=related_id, score=score)
+    for entry in RelatedQuestion.objects.filter(question=question_id)\
+                 [RELATED_QUESTIONS_COUNT:]:
+        entry.delete()
+    return True
+
+def recompute_related(question_ids):
+    "Recomputes the lists of the given questions from scratch"
+    for question in Question.objects.filter(pk__in=question_ids):
+        set_related(question, top_scores(score_related(question)))
+
+def update_related_questions(question):
+    """
+    Recomputes the related questions of `question` after its tags changed,
+    and updates its place in the lists of the questions it's related to.
+    Every question whose list changed gets its cached page invalidated.
+    """
+    scores = score_related(question)
+    ranked = top_scores(scores)
+    set_related(question, ranked)
+    changed = set([question.id])
+
+    # questions listing this one whose score changed or dropped to nothing
+    dropped = []
+    for entry in RelatedQuestion.objects.filter(related=question):
+        score = scores.get(entry.question_id)
+        if not score:
+            entry.delete()
+            dropped.append(entry.question_id)
+        elif score != entry.score:
+            entry.score = score
+            entry.save()
+            changed.add(entry.question_id)
+    # their lists now have room for a question they had to leave out
+    recompute_related(dropped)
+    changed.update(dropped)
+
+    # relatedness is symmetric: offer this question to the lists of its own
+    # related questions
+    for related_id, score in ranked:
+        if add_related(related_id, question.id, score):
+            changed.add(related_id)
+
+    invalidate(*['question:%s' % question_id for question_id in changed])
+
+def rebuild_related_questions():
+    "Recomputes the related questions of every question"
+    count = 0
+    for question in Question.objects.order_by('id').iterator():
+        set_related(question, top_scores(score_related(question)))
+        count += 1
+    return count
+
+def question_deleting(sender, instance, **kwargs):
+    # the delete cascades to the entries listing it, remember whose they were
+    instance._related_to = list(RelatedQuestion.objects.filter(related=instance)
+                                .values_list('question', flat=True))
+
+def question_deleted(sender, instance, **kwargs):
+    question_ids = getattr(instance, '_related_to', [])
+    recompute_related(question_ids)
+    invalidate(*['question:%s' % question_id for question_id in question_ids])
+
+pre_delete.connect(question_deleting, sender=Question)
+post_delete.connect(question_deleted, sender=Question)
+
+@section('related_questions')
+def get_related_questions(question):
+    return [entry.related for entry in RelatedQuestion.objects\
+            .filter(question=question)\
+            .select_related('related')[:RELATED_QUESTIONS_COUNT]]
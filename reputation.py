@@ -0,0 +1,328 @@
+"""
+The reputation ledger.
+
+A user's reputation is their profile's base reputation (set by an admin) plus
+the rep earned through votes on their questions and answers. Rather than
+walking every post and vote each time rep is displayed, every vote change
+books a ReputationEvent and adjusts Profile.earned_reputation, so reading rep
+is a single lookup.
+
+Permission checks ("may this user vote down?") go through has_reputation,
+which reads a cached copy of the user's rep and only looks it up again when
+the cached value is close enough to the requirement for staleness to matter.
+"""
+
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Count, F
+
+from quanda.instrumentation import record_cache, section
+from quanda.models import Profile, QuestionVote, AnswerVote, ReputationEvent
+
+QUESTION_VOTED_UP = getattr(settings, 'QUESTION_VOTED_UP', 10)
+QUESTION_VOTED_DOWN = getattr(settings, 'QUESTION_VOTED_DOWN', 5)
+ANSWER_VOTED_UP = getattr(settings, 'ANSWER_VOTED_UP', 10)
+ANSWER_VOTED_DOWN = getattr(settings, 'ANSWER_VOTED_DOWN', 5)
+
+# how long the rep used by permission checks may be cached, and how far from
+# a requirement the cached value has to be to be trusted
+REP_CACHE_TIMEOUT = getattr(settings, 'REP_CACHE_TIMEOUT', 60)
+REP_CACHE_MARGIN = getattr(settings, 'REP_CACHE_MARGIN', 10)
+
+def score_points(on_question, score):
+    "Returns the rep a vote of `score` on a question or an answer is worth"
+    if on_question:
+        up, down = QUESTION_VOTED_UP, QUESTION_VOTED_DOWN
+    else:
+        up, down = ANSWER_VOTED_UP, ANSWER_VOTED_DOWN
+
+    if score == 1:
+        return up
+    elif score == -1:
+        return down
+    return 0
+
+def vote_points(vote, score=None):
+    """
+    Returns the rep the author of the voted post gets for `vote`. If score is
+    given, it is used instead of the vote's current score.
+    """
+    if score is None:
+        score = vote.score
+    return score_points(isinstance(vote, QuestionVote), score)
+
+def get_vote_recipient(vote):
+    "Returns the author of the post the vote was cast on"
+    if isinstance(vote, QuestionVote):
+        return vote.question.author
+    return vote.answer.author
+
+def add_earned_reputation(user, points):
+    "Adds points to the user's earned reputation without reading it first"
+    updated = Profile.objects.filter(user=user)\
+              .update(earned_reputation=F('earned_reputation') + points)
+    if not updated:
+        Profile.objects.create(user=user, earned_reputation=points)
+    cache.delete(_rep_key(user.id))
+
+def record_vote(vote, previous_score=0):
+    """
+    Books the rep change caused by `vote` going from previous_score (0 for a
+    new vote) to its current score. Should run in the same transaction as the
+    save of the vote itself.
+    """
+    points = vote_points(vote) - vote_points(vote, previous_score)
+    if not points:
+        return None
+
+    recipient = get_vote_recipient(vote)
+    if recipient is None:
+        return None
+
+    event = ReputationEvent(user=recipient, points=points)
+    if isinstance(vote, QuestionVote):
+        event.question_vote = vote
+    else:
+        event.answer_vote = vote
+    event.save()
+
+    add_earned_reputation(recipient, points)
+    return event
+
+def compute_earned_reputation(user):
+    """
+    Calculates the rep a user earned straight from the vote tables. This is
+    the reference formula the ledger has to agree with.
+    """
+    score = 0
+    for question_vote in QuestionVote.objects.filter(question__author=user):
+        score += vote_points(question_vote)
+    for answer_vote in AnswerVote.objects.filter(answer__author=user):
+        score += vote_points(answer_vote)
+    return score
+
+def rebuild_user_ledger(user):
+    """
+    Throws away the user's ledger and books one event per vote currently on
+    their posts. Returns the new earned reputation.
+    """
+    ReputationEvent.objects.filter(user=user).delete()
+
+    total = 0
+    votes = list(QuestionVote.objects.filter(question__author=user)) + \
+            list(AnswerVote.objects.filter(answer__author=user))
+    for vote in votes:
+        points = vote_points(vote)
+        if not points:
+            continue
+        event = ReputationEvent(user=user, points=points)
+        if isinstance(vote, QuestionVote):
+            event.question_vote = vote
+        else:
+            event.answer_vote = vote
+        event.save()
+        total += points
+
+    Profile.objects.get_or_create(user=user)
+    Profile.objects.filter(user=user).update(earned_reputation=total)
+    return total
+
+def aggregate_earned_reputation(first_user_id, last_user_id):
+    """
+    Calculates the earned rep of every user whose id is in the given range
+    with two grouped queries: the votes on their questions and on their
+    answers, counted per author and score. Returns a dict of user id to
+    earned rep, users without votes being left out.
+    """
+    earned = {}
+    for on_question, votes, author in (
+            (True, QuestionVote.objects, 'question__author'),
+            (False, AnswerVote.objects, 'answer__author')):
+        rows = votes.filter(**{'%s__id__range' % author: (first_user_id, last_user_id)})\
+               .values_list(author, 'score').annotate(Count('id'))
+        for user_id, score, count in rows:
+            earned[user_id] = earned.get(user_id, 0) + \
+                              count * score_points(on_question, score)
+    return earned
+
+def recalculate_range(first_user_id, last_user_id, dry_run=False):
+    """
+    Recalculates the earned rep of the users in an id range and corrects the
+    ones that were wrong with one multi-row update, booking a correcting
+    ReputationEvent for each so the ledger still adds up. Profiles missing
+    in the range are created. Returns a list of (user id, stored, expected)
+    for the users whose rep was wrong.
+    The corrections are added to the stored rep rather than overwriting it,
+    so votes booked while the range is recalculated aren't lost.
+    """
+    expected = aggregate_earned_reputation(first_user_id, last_user_id)
+    stored = dict(Profile.objects.filter(user__id__range=(first_user_id, last_user_id))
+                  .values_list('user', 'earned_reputation'))
+    user_ids = User.objects.filter(id__range=(first_user_id, last_user_id))\
+               .values_list('id', flat=True)
+
+    changes = []
+    for user_id in user_ids:
+        if user_id not in stored or stored[user_id] != expected.get(user_id, 0):
+            changes.append((user_id, stored.get(user_id), expected.get(user_id, 0)))
+    if dry_run or not changes:
+        return changes
+
+    qn = connection.ops.quote_name
+    profile = Profile._meta
+    event = ReputationEvent._meta
+    now = datetime.datetime.now()
+    cursor = connection.cursor()
+    cursor.executemany("INSERT INTO %s (%s, %s, %s, %s, %s, %s) VALUES (%%s, 0, 0, '', '', '')" % (
+        qn(profile.db_table), qn(profile.get_field('user').column),
+        qn(profile.get_field('reputation').column),
+        qn(profile.get_field('earned_reputation').column),
+        qn(profile.get_field('website').column),
+        qn(profile.get_field('bio').column),
+        qn(profile.get_field('location').column),
+    ), [(user_id,) for user_id, before, after in changes if before is None])
+    cursor.executemany("UPDATE %s SET %s = %s + %%s WHERE %s = %%s" % (
+        qn(profile.db_table),
+        qn(profile.get_field('earned_reputation').column),
+        qn(profile.get_field('earned_reputation').column),
+        qn(profile.get_field('user').column),
+    ), [(after - (before or 0), user_id) for user_id, before, after in changes
+        if after != (before or 0)])
+    cursor.executemany("INSERT INTO %s (%s, %s, %s) VALUES (%%s, %%s, %%s)" % (
+        qn(event.db_table), qn(event.get_field('user').column),
+        qn(event.get_field('points').column),
+        qn(event.get_field('created').column),
+    ), [(user_id, after - (before or 0), now)
+        for user_id, before, after in changes if after != (before or 0)])
+    # raw queries don't mark the transaction as dirty
+    transaction.set_dirty()
+    return changes
+
+def seed_profiles(user_ids):
+    """
+    Creates the missing profiles of the given users at once, seeding their
+    ledger from the votes on their posts as rebuild_user_ledger does, with a
+    fixed number of queries however many users there are. Returns a dict of
+    user id to earned rep for the profiles created, or None if a concurrent
+    request created some of them first.
+    """
+    user_ids = list(User.objects.filter(pk__in=list(user_ids))
+                    .values_list('id', flat=True))
+    if not user_ids:
+        return {}
+
+    earned = dict([(user_id, 0) for user_id in user_ids])
+    events = []
+    for on_question, votes, author in (
+            (True, QuestionVote.objects, 'question__author'),
+            (False, AnswerVote.objects, 'answer__author')):
+        rows = votes.filter(**{'%s__in' % author: user_ids})\
+               .values_list(author, 'id', 'score')
+        for user_id, vote_id, score in rows:
+            points = score_points(on_question, score)
+            if not points:
+                continue
+            earned[user_id] += points
+            if on_question:
+                events.append((user_id, points, vote_id, None))
+            else:
+                events.append((user_id, points, None, vote_id))
+
+    qn = connection.ops.quote_name
+    profile = Profile._meta
+    event = ReputationEvent._meta
+    now = datetime.datetime.now()
+    cursor = connection.cursor()
+    sid = transaction.savepoint()
+    try:
+        cursor.executemany("INSERT INTO %s (%s, %s, %s, %s, %s, %s) VALUES (%%s, 0, %%s, '', '', '')" % (
+            qn(profile.db_table), qn(profile.get_field('user').column),
+            qn(profile.get_field('reputation').column),
+            qn(profile.get_field('earned_reputation').column),
+            qn(profile.get_field('website').column),
+            qn(profile.get_field('bio').column),
+            qn(profile.get_field('location').column),
+        ), earned.items())
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        return None
+    transaction.savepoint_commit(sid)
+    if events:
+        cursor.executemany("INSERT INTO %s (%s, %s, %s, %s, %s) VALUES (%%s, %%s, %%s, %%s, %%s)" % (
+            qn(event.db_table), qn(event.get_field('user').column),
+            qn(event.get_field('points').column),
+            qn(event.get_field('question_vote').column),
+            qn(event.get_field('answer_vote').column),
+            qn(event.get_field('created').column),
+        ), [(user_id, points, question_vote_id, answer_vote_id, now)
+            for user_id, points, question_vote_id, answer_vote_id in events])
+    # raw queries don't mark the transaction as dirty
+    if transaction.is_managed():
+        transaction.set_dirty()
+    else:
+        transaction.commit_unless_managed()
+    return earned
+
+@section('get_users_rep')
+def get_users_rep(user_ids):
+    """
+    Returns a dict of user id to total rep for all the given users. Users
+    seen for the first time get their profile, all of them in one go, so the
+    number of queries doesn't grow with the number of users.
+    """
+    user_ids = set([user_id for user_id in user_ids if user_id is not None])
+    if not user_ids:
+        return {}
+    reps = _stored_reps(user_ids)
+    missing = user_ids - set(reps)
+    if missing:
+        seeded = seed_profiles(missing)
+        if seeded is None:
+            # somebody else just created them: read what they stored
+            seeded = _stored_reps(missing)
+        reps.update(seeded)
+    return reps
+
+def _stored_reps(user_ids):
+    return dict([(user_id, base + earned) for user_id, base, earned in
+                 Profile.objects.filter(user__in=list(user_ids))
+                 .values_list('user', 'reputation', 'earned_reputation')])
+
+def _rep_key(user_id):
+    return 'quanda:rep:%s' % user_id
+
+@section('has_reputation')
+def has_reputation(user, required):
+    """
+    Returns whether the user has at least `required` rep. The answer comes
+    from a copy of their rep cached for up to REP_CACHE_TIMEOUT seconds,
+    unless that copy is within REP_CACHE_MARGIN points of the requirement,
+    in which case the stored rep is read instead.
+    """
+    if required <= 0:
+        return True
+    if not user.is_authenticated():
+        return False
+
+    key = _rep_key(user.id)
+    rep = cache.get(key)
+    record_cache(rep is not None)
+    if rep is None or abs(rep - required) < REP_CACHE_MARGIN:
+        rep = get_reputation(user)
+        cache.set(key, rep, REP_CACHE_TIMEOUT)
+    return rep >= required
+
+def get_reputation(user):
+    "Returns the user's total rep, creating their profile if needed"
+    try:
+        base, earned = Profile.objects.filter(user=user)\
+                       .values_list('reputation', 'earned_reputation')[0]
+    except IndexError:
+        # first time we see this user: seed the ledger from their votes
+        Profile.objects.get_or_create(user=user)
+        return rebuild_user_ledger(user)
+    return base + earned
@@ -0,0 +1,99 @@
+"""
+Read replica routing.
+
+ReplicaRouter sends reads to one of the REPLICA_DATABASES and writes to
+PRIMARY_DATABASE. Reads go back to the primary, for the rest of the request,
+as soon as the request writes anything, so a request always reads what it
+just wrote.
+
+Replicas lag behind, so after a user votes, asks, answers or comments (the
+code doing so calls user_wrote()), ReplicaMiddleware sets a cookie keeping
+all of their requests on the primary for REPLICA_STICKY_SECONDS: they see
+their own writes right away, everybody else eventually. Other writes, such
+as view counts, don't make a user sticky.
+
+Only requests going through the middleware read from replicas: management
+commands and other code running outside a request use the primary. Only
+quanda's models are routed, so sessions, users and the like stay wherever
+the rest of the site keeps them.
+
+This needs django 1.2's multiple databases: see the README for the settings.
+"""
+
+import random
+import threading
+import time
+
+from django.conf import settings
+
+PRIMARY_DATABASE = getattr(settings, 'PRIMARY_DATABASE', 'default')
+REPLICA_DATABASES = getattr(settings, 'REPLICA_DATABASES', [])
+REPLICA_STICKY_SECONDS = getattr(settings, 'REPLICA_STICKY_SECONDS', 10)
+REPLICA_STICKY_COOKIE = 'quanda_primary'
+
+_local = threading.local()
+
+def use_primary():
+    "Whether reads of the current thread go to the primary"
+    return getattr(_local, 'use_primary', True)
+
+def set_use_primary(value):
+    _local.use_primary = value
+
+def start(use_primary=False):
+    _local.use_primary = use_primary
+    _local.sticky_write = False
+
+def user_wrote():
+    "Notes that the request's user wrote content they'll expect to see"
+    _local.use_primary = True
+    _local.sticky_write = True
+
+def end():
+    "Returns whether user_wrote() was called during the request"
+    sticky_write = getattr(_local, 'sticky_write', False)
+    _local.use_primary = True
+    _local.sticky_write = False
+    return sticky_write
+
+class ReplicaRouter(object):
+    """
+    Add 'quanda.routers.ReplicaRouter' to DATABASE_ROUTERS. Only quanda's
+    own models are routed: the others (sessions, auth...) are left to the
+    next router or the default database.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'quanda':
+            return None
+        if use_primary() or not REPLICA_DATABASES:
+            return PRIMARY_DATABASE
+        return random.choice(REPLICA_DATABASES)
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != 'quanda':
+            return None
+        _local.use_primary = True
+        return PRIMARY_DATABASE
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if 'quanda' not in (obj1._meta.app_label, obj2._meta.app_label):
+            return None
+        # replicas hold the same data as the primary
+        databases = [PRIMARY_DATABASE] + list(REPLICA_DATABASES)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if db in REPLICA_DATABASES:
+            return False
+        return None
+
+def is_sticky(request):
+    "Whether the request's user wrote recently, and should read the primary"
+    try:
+        until = float(request.COOKIES.get(REPLICA_STICKY_COOKIE, 0))
+    except ValueError:
+        return False
+    return until > time.time()
@@ -0,0 +1,241 @@
+"""
+Quanda's full text search.
+
+Questions are indexed together with their tags and answers in an inverted
+index stored in the database (SearchTerm / SearchDocument), so no external
+search service is needed. Queries are ranked with BM25.
+"""
+
+import datetime
+import math
+import operator
+import re
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Avg, Count, F, Q
+from django.utils.html import strip_tags
+
+from quanda.instrumentation import section
+from quanda.models import Question, Answer, SearchDocument, SearchTerm
+
+# how much more a term counts when it's in the title or a tag
+SEARCH_TITLE_WEIGHT = getattr(settings, 'SEARCH_TITLE_WEIGHT', 3)
+SEARCH_TAG_WEIGHT = getattr(settings, 'SEARCH_TAG_WEIGHT', 3)
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+MAX_TERM_LENGTH = 40
+
+STOP_WORDS = frozenset("""
+a about an and are as at be but by can do for from has have how i if in into
+is it its me my no not of on or so than that the their them then there these
+they this to was we what when where which who why will with you your
+""".split())
+
+WORD_RE = re.compile(r"[a-z0-9]+")
+
+def stem(word):
+    """
+    A light suffix stripper, in the spirit of the Porter stemmer, so that
+    'answers', 'answered' and 'answering' all end up as 'answer'.
+    """
+    if len(word) <= 3 or word.isdigit():
+        return word
+
+    if word.endswith('sses'):
+        return word[:-2]
+    if word.endswith('ies'):
+        return word[:-3] + 'y'
+    if word.endswith('ss') or word.endswith('us') or word.endswith('is'):
+        return word
+    if word.endswith('es') and len(word) > 4 and \
+       word[:-2].endswith(('s', 'x', 'z', 'ch', 'sh')):
+        return word[:-2]
+
+    for suffix in ('ations', 'ation', 'ments', 'ment', 'ness', 'ings', 'ing',
+                   'edly', 'ed', 'ly', 's'):
+        if word.endswith(suffix):
+            stemmed = word[:-len(suffix)]
+            # only strip if a real stem is left behind
+            if len(stemmed) < 3 or not re.search('[aeiouy]', stemmed):
+                continue
+            if suffix in ('ing', 'ings', 'ed', 'edly') and \
+               len(stemmed) > 3 and stemmed[-1] == stemmed[-2] and \
+               stemmed[-1] not in 'lsz':
+                # running -> run
+                stemmed = stemmed[:-1]
+            return stemmed
+    return word
+
+def tokenize(text):
+    "Returns the list of stemmed terms of a piece of (html) text"
+    terms = []
+    for word in WORD_RE.findall(strip_tags(text or '').lower()):
+        if word in STOP_WORDS or len(word) < 2:
+            continue
+        terms.append(stem(word)[:MAX_TERM_LENGTH])
+    return terms
+
+def add_terms(frequencies, text, weight=1):
+    "Adds the terms of a piece of text to a dict of term to frequency"
+    for term in tokenize(text):
+        frequencies[term] = frequencies.get(term, 0) + weight
+    return frequencies
+
+def get_question_terms(question):
+    "Returns a dict of term to weighted frequency for a question"
+    frequencies = {}
+    add_terms(frequencies, question.title, SEARCH_TITLE_WEIGHT)
+    add_terms(frequencies, question.question_text)
+    for title in question.tags.values_list('title', flat=True):
+        add_terms(frequencies, title, SEARCH_TAG_WEIGHT)
+    for answer_text in Answer.objects.filter(question=question)\
+                       .values_list('answer_text', flat=True):
+        add_terms(frequencies, answer_text)
+    return frequencies
+
+def write_postings(question_id, stored, frequencies):
+    """
+    Takes the postings of a question from `stored` to `frequencies` (both
+    dicts of term to frequency), only writing the terms that changed: one
+    query for the removed terms, and one batch each of updates and inserts.
+    """
+    removed = [term for term in stored if not frequencies.get(term)]
+    updated = [(frequency, question_id, term)
+               for term, frequency in frequencies.items()
+               if frequency and term in stored and stored[term] != frequency]
+    added = [(term, question_id, frequency)
+             for term, frequency in frequencies.items()
+             if frequency and term not in stored]
+
+    if removed:
+        SearchTerm.objects.filter(question=question_id, term__in=removed).delete()
+    if not updated and not added:
+        return
+
+    qn = connection.ops.quote_name
+    opts = SearchTerm._meta
+    cursor = connection.cursor()
+    if updated:
+        cursor.executemany("UPDATE %s SET %s = %%s WHERE %s = %%s AND %s = %%s" % (
+            qn(opts.db_table),
+            qn(opts.get_field('frequency').column),
+            qn(opts.get_field('question').column),
+            qn(opts.get_field('term').column),
+        ), updated)
+    if added:
+        cursor.executemany("INSERT INTO %s (%s, %s, %s) VALUES (%%s, %%s, %%s)" % (
+            qn(opts.db_table),
+            qn(opts.get_field('term').column),
+            qn(opts.get_field('question').column),
+            qn(opts.get_field('frequency').column),
+        ), added)
+    # raw queries don't mark the transaction as dirty
+    if transaction.is_managed():
+        transaction.set_dirty()
+    else:
+        transaction.commit_unless_managed()
+
+def index_question(question):
+    """
+    (Re)indexes a question along with its tags and answers. Called whenever
+    a question is saved, in the caller's transaction.
+    """
+    frequencies = get_question_terms(question)
+    stored = dict(SearchTerm.objects.filter(question=question)
+                  .values_list('term', 'frequency'))
+    write_postings(question.id, stored, frequencies)
+
+    document = SearchDocument.objects.get_or_create(question=question)[0]
+    document.length = sum(frequencies.values())
+    document.indexed = datetime.datetime.now()
+    document.save()
+
+def index_answer(question, old_text, new_text):
+    """
+    Updates the index of a question after one of its answers went from
+    old_text to new_text (old_text is empty for a new answer, new_text for a
+    deleted one), without going through the rest of the question.
+    """
+    changes = add_terms({}, new_text)
+    for term, frequency in add_terms({}, old_text).items():
+        changes[term] = changes.get(term, 0) - frequency
+    changes = dict([(term, change) for term, change in changes.items() if change])
+    if not changes:
+        return
+
+    updated = SearchDocument.objects.filter(question=question).update(
+        length=F('length') + sum(changes.values()),
+        indexed=datetime.datetime.now())
+    if not updated:
+        # never indexed: index all of it
+        index_question(question)
+        return
+
+    stored = dict(SearchTerm.objects.filter(question=question, term__in=changes.keys())
+                  .values_list('term', 'frequency'))
+    write_postings(question.id, stored, dict([
+        (term, stored.get(term, 0) + change) for term, change in changes.items()]))
+
+def rebuild_index():
+    """
+    Reindexes every question, each in its own transaction, and returns how
+    many were indexed
+    """
+    index = transaction.commit_on_success(index_question)
+    count = 0
+    for question in Question.objects.order_by('id').iterator():
+        index(question)
+        count += 1
+    return count
+
+def with_tags(queryset, tags, lookup='tags__title'):
+    """
+    Keeps the rows of queryset tagged with at least one of tags, whatever
+    the case of their titles
+    """
+    return queryset.filter(reduce(operator.or_, [
+        Q(**{str(lookup + '__iexact'): tag}) for tag in tags])).distinct()
+
+@section('search')
+def search_questions(query, tags=None):
+    """
+    Returns (question id, score) pairs for the questions matching the query,
+    best match first.
+    If tags (a list of tag titles) is given, only questions with at least one
+    of these tags are returned.
+    """
+    terms = list(set(tokenize(query)))
+    if not terms:
+        return []
+
+    postings = SearchTerm.objects.filter(term__in=terms)
+    if tags:
+        postings = with_tags(postings, tags, 'question__tags__title')
+    postings = list(postings.values_list('question', 'term', 'frequency')\
+                    .distinct())
+    if not postings:
+        return []
+
+    document_count = SearchDocument.objects.count()
+    average_length = SearchDocument.objects.aggregate(
+        average=Avg('length'))['average'] or 1.0
+    document_frequencies = dict(SearchTerm.objects.filter(term__in=terms)\
+                                .values_list('term').annotate(Count('id')))
+    lengths = dict(SearchDocument.objects\
+                   .filter(question__in=set([p[0] for p in postings]))\
+                   .values_list('question', 'length'))
+
+    scores = {}
+    for question_id, term, frequency in postings:
+        df = document_frequencies.get(term, 0)
+        idf = math.log(1 + (document_count - df + 0.5) / (df + 0.5))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B *
+                          lengths.get(question_id, average_length) / average_length)
+        scores[question_id] = scores.get(question_id, 0) + \
+            idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+
+    return sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
@@ -0,0 +1,2 @@
+-- question pages list a question's answers chosen first, then by score, then newest first
+CREATE INDEX quanda_answer_question_rank ON quanda_answer (question_id, user_chosen, score, posted, id);
@@ -0,0 +1,2 @@
+-- comments are always fetched for a given post, in posting order
+CREATE INDEX quanda_comment_object ON quanda_comment (content_type_id, object_id, posted);
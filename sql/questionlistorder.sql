@@ -0,0 +1,2 @@
+-- list pages walk a list's questions in order
+CREATE INDEX quanda_questionlistorder_list_order ON quanda_questionlistorder (question_list_id, "order", id);
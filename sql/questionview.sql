@@ -0,0 +1,2 @@
+-- record_view looks views up by question and session
+CREATE INDEX quanda_questionview_question_session ON quanda_questionview (question_id, session);
@@ -0,0 +1,79 @@
+"""
+The tag directory: every tag's title, id and number of questions, sorted by
+title, built with one grouped query and kept in the cache (and in process)
+until the 'tags' version changes, which happens whenever a tag is created,
+renamed or deleted (see quanda.caching), or a question's tags change, so
+the question counts autocomplete ranks by stay current. Pages that need tags
+read them from here instead of querying all of them.
+
+Titles are looked up by their normalized form (see normalize), but shown as
+they were entered.
+"""
+
+import bisect
+import time
+
+from django.core.cache import cache
+from django.db.models import Count
+
+from quanda.caching import PAGE_CACHE_TIMEOUT, get_version
+from quanda.instrumentation import record_cache, section
+from quanda.models import QuestionTag
+
+# (version, directory, sorted keys, key to tag, time read) of the last
+# directory this process read, replaced as a whole so threads never see a mix
+_local = [(None, None, None, None, 0)]
+
+def normalize(title):
+    return u' '.join(title.split()).lower()
+
+def _key(version):
+    return 'quanda:tag_directory:%s' % version
+
+@section('tag_directory')
+def _load():
+    version = get_version('tags')
+    if _local[0][0] == version and time.time() - _local[0][4] < PAGE_CACHE_TIMEOUT:
+        return _local[0]
+
+    directory = cache.get(_key(version))
+    record_cache(directory is not None)
+    if directory is None:
+        directory = [{'title': title, 'key': normalize(title), 'id': id,
+                      'question_count': count}
+                     for title, id, count in QuestionTag.objects
+                     .values_list('title', 'id').annotate(Count('questions'))]
+        directory.sort(key=lambda tag: tag['key'])
+        cache.set(_key(version), directory, PAGE_CACHE_TIMEOUT)
+    _local[0] = (version, directory, [tag['key'] for tag in directory],
+                 dict([(tag['key'], tag) for tag in directory]), time.time())
+    return _local[0]
+
+def get_directory():
+    """
+    Returns the directory, a list of {'title', 'key', 'id', 'question_count'}
+    dicts sorted by key, the normalized title.
+    """
+    return _load()[1]
+
+def get_tags(titles):
+    """
+    Returns the directory entries of the given titles, in the same order.
+    Titles without a tag are returned as None.
+    """
+    by_key = _load()[3]
+    return [by_key.get(normalize(title)) for title in titles]
+
+def complete(prefix, limit=10):
+    "Returns up to limit tags whose title starts with prefix, most used first"
+    prefix = normalize(prefix)
+    if not prefix:
+        return []
+    directory, keys = _load()[1:3]
+    matches = []
+    for i in range(bisect.bisect_left(keys, prefix), len(keys)):
+        if not keys[i].startswith(prefix):
+            break
+        matches.append(directory[i])
+    matches.sort(key=lambda tag: -tag['question_count'])
+    return matches[:limit]
@@ -1,12 +1,16 @@
+from __future__ import absolute_import
+
 from django import template
 from django.core.urlresolvers import reverse
 
-from ..quanda.utils import get_user_rep, smart_date
+from quanda import identity
+from quanda.utils import smart_date
 
 register = template.Library()
 
-def rep(username):
-    return get_user_rep(username)
+def rep(user):
+    "The rep of a user, given as a User (preferably), an id or a username"
+    return identity.get_rep(user)
 
 def smartdate(event):
     return smart_date(event)
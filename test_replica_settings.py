@@ -0,0 +1,26 @@
+"""
+Settings to run the read replica router's tests with (django 1.2+), from the
+directory holding quanda:
+$ django-admin.py test quanda.ReplicaRouterTest --settings=quanda.test_replica_settings
+
+The primary's test database is a file rather than sqlite's default in
+memory one, so the replica mirroring it opens the same database instead of
+an empty one of its own.
+"""
+
+from quanda.test_settings import *
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'quanda_test.db',
+        'TEST_NAME': 'quanda_test_primary.db',
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'quanda_test_replica.db',
+        'TEST_MIRROR': 'default',
+    },
+}
+DATABASE_ROUTERS = ['quanda.routers.ReplicaRouter']
+REPLICA_DATABASES = ['replica']
@@ -0,0 +1,37 @@
+"""
+Settings to run quanda's tests with, from the directory holding quanda:
+$ django-admin.py test quanda --settings=quanda.test_settings
+
+See test_replica_settings for the read replica router's tests.
+"""
+
+DATABASE_ENGINE = 'sqlite3'
+DATABASE_NAME = 'quanda_test.db'
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'quanda_test.db',
+    },
+}
+
+INSTALLED_APPS = (
+    'django.contrib.admin',
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.sessions',
+    'django.contrib.sitemaps',
+    'django.contrib.sites',
+    'quanda',
+)
+
+MIDDLEWARE_CLASSES = (
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'quanda.middleware.IdentityMapMiddleware',
+    'quanda.middleware.ReplicaMiddleware',
+)
+
+ROOT_URLCONF = 'quanda.urls'
+SITE_ID = 1
+CACHE_BACKEND = 'locmem://'
@@ -0,0 +1,149 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.urlresolvers import reverse
+from django.db import connection, reset_queries
+from django.test import TestCase, TransactionTestCase
+
+from quanda import routers
+from quanda.models import Question, QuestionVote, Answer, AnswerVote, Comment, Profile, ReputationEvent
+from quanda.reputation import QUESTION_VOTED_UP, recalculate_range
+
+class QuestionReadQueriesTest(TestCase):
+    """
+    question_read builds its page in a fixed number of queries, however many
+    answers, comments and voters it shows.
+    """
+
+    def setUp(self):
+        # connection.queries is only filled in debug mode
+        self.old_debug = settings.DEBUG
+        settings.DEBUG = True
+        # content types are cached once looked up, keep that out of the count
+        ContentType.objects.get_for_model(Question)
+        ContentType.objects.get_for_model(Answer)
+        self.viewer = User.objects.create_user('viewer', 'viewer@example.com', 'secret')
+        self.client.login(username='viewer', password='secret')
+
+    def tearDown(self):
+        settings.DEBUG = self.old_debug
+
+    def create_question(self, answer_count):
+        "A question with answer_count answers, each by its own user, commented and voted on"
+        author = User.objects.create_user('author%s' % answer_count, '', 'secret')
+        question = Question.objects.create(title='question', question_text='text',
+                                           author=author)
+        answer_type = ContentType.objects.get_for_model(Answer)
+        for i in range(answer_count):
+            answerer = User.objects.create_user('answerer%s_%s' % (answer_count, i),
+                                                '', 'secret')
+            answer = Answer.objects.create(question=question, author=answerer,
+                                           answer_text='answer %s' % i)
+            Comment.objects.create(user=author, comment_text='comment', ip='127.0.0.1',
+                                   content_type=answer_type, object_id=answer.id)
+            Answer.objects.filter(pk=answer.pk).update(comment_count=1)
+            AnswerVote.objects.create(user=self.viewer, answer=answer, score=1)
+        return question
+
+    def count_queries(self, answer_count):
+        # a new question each time, so none of its fragments are cached
+        question = self.create_question(answer_count)
+        reset_queries()
+        response = self.client.get(reverse('quanda_question_read', args=[question.id]))
+        self.assertEqual(response.status_code, 200)
+        return len(connection.queries)
+
+    def test_queries_dont_grow_with_answers(self):
+        self.assertEqual(self.count_queries(2), self.count_queries(20))
+
+class RecalculateReputationTest(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user('author', '', 'secret')
+        self.voter = User.objects.create_user('voter', '', 'secret')
+        question = Question.objects.create(title='question', author=self.author)
+        # a vote the ledger never heard of, and a wrong stored rep
+        QuestionVote.objects.create(user=self.voter, question=question, score=1)
+        Profile.objects.create(user=self.author, earned_reputation=3)
+        self.user_range = (min(self.author.id, self.voter.id),
+                           max(self.author.id, self.voter.id))
+
+    def test_dry_run_writes_nothing(self):
+        changes = recalculate_range(dry_run=True, *self.user_range)
+        self.assertEqual(sorted(changes), sorted([
+            (self.author.id, 3, QUESTION_VOTED_UP), (self.voter.id, None, 0)]))
+        self.assertEqual(Profile.objects.get(user=self.author).earned_reputation, 3)
+        self.failIf(Profile.objects.filter(user=self.voter))
+
+    def test_corrects_rep_and_ledger(self):
+        recalculate_range(*self.user_range)
+        self.assertEqual(Profile.objects.get(user=self.author).earned_reputation,
+                         QUESTION_VOTED_UP)
+        self.assertEqual(Profile.objects.get(user=self.voter).earned_reputation, 0)
+        self.assertEqual(list(ReputationEvent.objects.filter(user=self.author)
+                              .values_list('points', flat=True)),
+                         [QUESTION_VOTED_UP - 3])
+        # nothing left to correct
+        self.assertEqual(recalculate_range(*self.user_range), [])
+
+
+class FakeRequest(object):
+    def __init__(self, cookies):
+        self.COOKIES = cookies
+
+if 'quanda.routers.ReplicaRouter' in getattr(settings, 'DATABASE_ROUTERS', []):
+    class ReplicaRouterTest(TransactionTestCase):
+        """
+        Runs with the primary and replica sqlite databases of
+        test_replica_settings. The test data is committed, so the replica
+        sees it even through a connection of its own.
+        """
+
+        def setUp(self):
+            self.author = User.objects.create_user('author', '', 'secret')
+            self.voter = User.objects.create_user('voter', '', 'secret')
+            Profile.objects.create(user=self.voter, reputation=1000)
+            self.question = Question.objects.create(title='question',
+                                                    author=self.author)
+            self.client.login(username='voter', password='secret')
+
+        def tearDown(self):
+            routers.end()
+
+        def test_reads_go_to_the_replica(self):
+            routers.start()
+            self.assertEqual(Question.objects.all().db, 'replica')
+
+        def test_writes_go_to_the_primary(self):
+            routers.start()
+            self.assertEqual(routers.ReplicaRouter().db_for_write(Question), 'default')
+            self.question.save()
+            self.assertEqual(self.question._state.db, 'default')
+            # and so do the request's reads, from then on
+            self.assertEqual(Question.objects.all().db, 'default')
+
+        def test_reads_outside_requests_go_to_the_primary(self):
+            self.assertEqual(Question.objects.all().db, 'default')
+
+        def test_other_apps_are_not_routed(self):
+            routers.start()
+            router = routers.ReplicaRouter()
+            self.assertEqual(router.db_for_read(User), None)
+            self.assertEqual(router.db_for_write(User), None)
+            # and writing them doesn't send the request's reads to the primary
+            self.assertEqual(Question.objects.all().db, 'replica')
+
+        def test_voting_pins_the_user_to_the_primary(self):
+            response = self.client.post(reverse('quanda_api_question_vote_up',
+                                                args=[self.question.id]))
+            self.assertEqual(response.status_code, 200)
+            cookie = response.cookies[routers.REPLICA_STICKY_COOKIE]
+            self.assertEqual(cookie['max-age'], routers.REPLICA_STICKY_SECONDS)
+            self.failUnless(routers.is_sticky(FakeRequest({
+                routers.REPLICA_STICKY_COOKIE: cookie.value})))
+
+        def test_viewing_does_not_pin_the_user(self):
+            response = self.client.get(reverse('quanda_record_view',
+                                               args=[self.question.id]))
+            self.assertEqual(response.status_code, 200)
+            self.failIf(routers.REPLICA_STICKY_COOKIE in response.cookies)
+            self.failIf(routers.is_sticky(FakeRequest({})))
@@ -1,10 +1,11 @@
 from django.conf.urls.defaults import patterns, url, include
 
-from quanda.feeds import RssQuestions, RssAnswers
+from quanda.feeds import RssQuestions, RssAnswers, RssAllAnswers
 
 feeds = {
     'latest': RssQuestions,
     'answers': RssAnswers,
+    'all-answers': RssAllAnswers,
 }
 
 urlpatterns = patterns('quanda.views',
@@ -19,6 +20,7 @@ urlpatterns = patterns('quanda.views',
     url(r'^(?P<question_id>\d+)/voteup/$', 'voting.question_adjust_vote', kwargs={'delta': 1}, name='quanda_question_vote_up'),
     url(r'^(?P<question_id>\d+)/votedown/$', 'voting.question_adjust_vote', kwargs={'delta': -1}, name='quanda_question_vote_down'),
     url(r'^(?P<question_id>\d+)/record_view/$', 'record_view', name='quanda_record_view'),
+    url(r'^comments/(?P<post_type>question|answer)/(?P<object_id>\d+)/$', 'comments', name='quanda_comments'),
     url(r'^(?P<question_id>\d+)/', 'question_read', {'msg':'test'}, name='quanda_question_read'),
     
     url(r'^lists/$', 'lists', name='quanda_lists'),
@@ -33,10 +35,21 @@ urlpatterns = patterns('quanda.views',
     url(r'^tags/admin/(?P<tag_id>\d+)/delete/$', 'delete_tag', name='quanda_delete_tag'),
     url(r'^tags/(?P<tag_id>\w+)/$', 'view_tag', name='quanda_view_tag'),
         
+    url(r'^stats/$', 'stats', name='quanda_stats'),
+
+    url(r'^api/(?P<question_id>\d+)/voteup/$', 'api.question_vote', kwargs={'delta': 1}, name='quanda_api_question_vote_up'),
+    url(r'^api/(?P<question_id>\d+)/votedown/$', 'api.question_vote', kwargs={'delta': -1}, name='quanda_api_question_vote_down'),
+    url(r'^api/(?P<question_id>\d+)/record_view/$', 'api.record_view', name='quanda_api_record_view'),
+    url(r'^api/answers/(?P<answer_id>\d+)/voteup/$', 'api.answer_vote', kwargs={'delta': 1}, name='quanda_api_answer_vote_up'),
+    url(r'^api/answers/(?P<answer_id>\d+)/votedown/$', 'api.answer_vote', kwargs={'delta': -1}, name='quanda_api_answer_vote_down'),
+    url(r'^api/answers/(?P<answer_id>\d+)/pick/$', 'api.pick_answer', name='quanda_api_pick_answer'),
+    url(r'^api/comment/$', 'api.comment', name='quanda_api_comment'),
+    url(r'^api/tags/$', 'api.tag_complete', name='quanda_api_tag_complete'),
+
     (r'^install/$', 'install'),
     
 )
 
-urlpatterns += patterns('django.contrib.syndication.views',
+urlpatterns += patterns('quanda.feeds',
     url(r'^feeds/(?P<url>.*)/$', 'feed', {'feed_dict': feeds}, name='quanda_feed'),
 )
\ No newline at end of file
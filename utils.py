@@ -3,46 +3,61 @@ import re
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db.models import Sum
+from django.db.models import F, signals
 
-from quanda.models import Question, QuestionVote, Profile, Answer, AnswerVote
-
-QUESTION_VOTED_UP = getattr(settings, 'QUESTION_VOTED_UP', 10)
-QUESTION_VOTED_DOWN = getattr(settings, 'QUESTION_VOTED_DOWN', 5)
-ANSWER_VOTED_UP = getattr(settings, 'ANSWER_VOTED_UP', 10)
-ANSWER_VOTED_DOWN = getattr(settings, 'ANSWER_VOTED_DOWN', 5)
+from quanda.instrumentation import section
+from quanda.models import Profile
+from quanda.reputation import QUESTION_VOTED_UP, QUESTION_VOTED_DOWN, ANSWER_VOTED_UP, ANSWER_VOTED_DOWN, get_reputation
 
+@section('get_user_rep')
 def get_user_rep(username):
     """
-    Returns a user's rep, calculated by based on base rep (usually 0 unless
-    otherwise assigned by an admin) plus questions and answers being
-    voted up or down
+    Returns a user's rep: their base rep (usually 0 unless otherwise assigned
+    by an admin) plus the rep earned from their questions and answers being
+    voted up or down, as recorded by the reputation ledger.
     """
-    
+
     try:
-        user = User.objects.get(username=username)
-    except User.DoesNotExist:
-        return 0
+        base, earned = Profile.objects.filter(user__username=username)\
+                       .values_list('reputation', 'earned_reputation')[0]
+    except IndexError:
+        try:
+            user = User.objects.get(username=username)
+        except User.DoesNotExist:
+            return 0
+        return get_reputation(user)
 
-    profile = Profile.objects.get_or_create(user=user)[0]    
-    score = profile.reputation
+    return base + earned
+    
+def adjust_vote_counters(obj, previous_score, score):
+    """
+    Updates the stored score and vote count of a question or answer after
+    one of its votes went from previous_score to score. The update is done
+    with F() expressions so concurrent votes don't overwrite each other.
+    """
+    delta = score - previous_score
+    count_delta = int(score != 0) - int(previous_score != 0)
+    if not delta and not count_delta:
+        return
 
-    for question in Question.objects.filter(author=profile.user):
-         for question_vote in QuestionVote.objects.filter(question=question):
-            if question_vote.score == 1:
-                score += QUESTION_VOTED_UP
-            elif question_vote.score == -1:
-                score += QUESTION_VOTED_DOWN
+    obj.__class__.objects.filter(pk=obj.pk).update(
+        score=F('score') + delta,
+        vote_count=F('vote_count') + count_delta,
+    )
+    obj.score += delta
+    obj.vote_count += count_delta
 
-    for answer in Answer.objects.filter(author=profile.user):
-        for answer_vote in AnswerVote.objects.filter(answer=answer):
-            if answer_vote.score == 1:
-                score += ANSWER_VOTED_UP
-            elif answer_vote.score == -1:
-                score += ANSWER_VOTED_DOWN
+def save_fields(obj, *fields):
+    """
+    Saves only the given fields of an existing object (a question, answer or
+    profile), so its counters, updated concurrently with F() expressions,
+    aren't written back stale as a full save() would. Sends post_save like
+    save() does.
+    """
+    obj.__class__.objects.filter(pk=obj.pk).update(
+        **dict([(field, getattr(obj, field)) for field in fields]))
+    signals.post_save.send(sender=obj.__class__, instance=obj, created=False)
 
-    return score
-    
 def strip_js(html_string):
     """
     This function should remove any javascript from an html string. For now,
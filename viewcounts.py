@@ -0,0 +1,171 @@
+"""
+Buffered question view counting.
+
+With VIEW_BUFFERING on, record_view doesn't touch the database: views are
+deduplicated per (question, session) in the cache, queued in process and
+written in bulk, along with the view_count increments, once the queue holds
+VIEW_BUFFER_SIZE views or VIEW_BUFFER_INTERVAL seconds went by (a timer
+flushes the queue of a process that stops getting views). The view count
+shown to users is served from the cache, and rebuilt from the database and
+the number of views every process still has queued when it expires.
+"""
+
+import atexit
+import datetime
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F
+
+from quanda.models import Question, QuestionView
+
+VIEW_BUFFERING = getattr(settings, 'VIEW_BUFFERING', False)
+VIEW_BUFFER_SIZE = getattr(settings, 'VIEW_BUFFER_SIZE', 100)
+VIEW_BUFFER_INTERVAL = getattr(settings, 'VIEW_BUFFER_INTERVAL', 10)
+# how long a session's view of a question is remembered to avoid counting
+# it twice
+VIEW_DEDUPE_TIMEOUT = getattr(settings, 'VIEW_DEDUPE_TIMEOUT', 60 * 60 * 24)
+
+_pending = []
+_lock = threading.Lock()
+_last_flush = [time.time()]
+_timer = [None]
+
+def _count_key(question_id):
+    return 'quanda:view_count:%s' % question_id
+
+def _queued_key(question_id):
+    # views of the question queued by all processes, not written yet
+    return 'quanda:view_queued:%s' % question_id
+
+def _seen_key(question_id, session):
+    return 'quanda:view_seen:%s:%s' % (question_id, session)
+
+def _add_queued(question_id, count):
+    key = _queued_key(question_id)
+    cache.add(key, 0, VIEW_DEDUPE_TIMEOUT)
+    try:
+        if count > 0:
+            cache.incr(key, count)
+        else:
+            cache.decr(key, -count)
+    except ValueError:
+        pass
+
+def get_view_count(question):
+    "Returns the view count of a question, including views not yet written"
+    count = cache.get(_count_key(question.id))
+    if count is None:
+        count = Question.objects.filter(pk=question.id)\
+                .values_list('view_count', flat=True)[0] + \
+                max(cache.get(_queued_key(question.id)) or 0, 0)
+        cache.set(_count_key(question.id), count, VIEW_DEDUPE_TIMEOUT)
+    return count
+
+def _schedule_flush():
+    "Flushes the queue in VIEW_BUFFER_INTERVAL seconds, should no view come in"
+    if _timer[0] is None:
+        _timer[0] = threading.Timer(VIEW_BUFFER_INTERVAL, _timed_flush)
+        _timer[0].setDaemon(True)
+        _timer[0].start()
+
+def _timed_flush():
+    _lock.acquire()
+    try:
+        _timer[0] = None
+    finally:
+        _lock.release()
+    try:
+        flush()
+    finally:
+        # the timer's thread has a connection of its own
+        connection.close()
+
+def record_view(question, ip, session):
+    """
+    Queues a view of the question unless this session already viewed it, and
+    returns the question's view count.
+    """
+    if not cache.add(_seen_key(question.id, session), 1, VIEW_DEDUPE_TIMEOUT):
+        return get_view_count(question)
+
+    # counted as queued first, so a flush never takes it off before it's on
+    _add_queued(question.id, 1)
+    _lock.acquire()
+    try:
+        _pending.append((question.id, ip, session, datetime.datetime.now()))
+        should_flush = len(_pending) >= VIEW_BUFFER_SIZE or \
+                       time.time() - _last_flush[0] >= VIEW_BUFFER_INTERVAL
+        if not should_flush:
+            _schedule_flush()
+    finally:
+        _lock.release()
+
+    try:
+        count = cache.incr(_count_key(question.id))
+    except ValueError:
+        count = get_view_count(question)
+
+    if should_flush:
+        flush()
+    return count
+
+def flush():
+    """
+    Writes all the queued views with a single multi-row insert, then bumps
+    each viewed question's view_count once. Returns the number of views
+    written.
+    """
+    _lock.acquire()
+    try:
+        views = _pending[:]
+        del _pending[:]
+        _last_flush[0] = time.time()
+    finally:
+        _lock.release()
+
+    if not views:
+        return 0
+
+    per_question = {}
+    for view in views:
+        per_question[view[0]] = per_question.get(view[0], 0) + 1
+    try:
+        _write(views, per_question)
+    except:
+        # put them back, ahead of the views queued meanwhile, for the next
+        # flush to retry
+        _lock.acquire()
+        try:
+            _pending[:0] = views
+        finally:
+            _lock.release()
+        raise
+    # only once committed, so rebuilt counts never miss them
+    for question_id, count in per_question.items():
+        _add_queued(question_id, -count)
+    return len(views)
+
+@transaction.commit_on_success
+def _write(views, per_question):
+    qn = connection.ops.quote_name
+    opts = QuestionView._meta
+    cursor = connection.cursor()
+    cursor.executemany("INSERT INTO %s (%s, %s, %s, %s) VALUES (%%s, %%s, %%s, %%s)" % (
+        qn(opts.db_table),
+        qn(opts.get_field('question').column),
+        qn(opts.get_field('ip').column),
+        qn(opts.get_field('session').column),
+        qn(opts.get_field('created').column),
+    ), views)
+    transaction.set_dirty()
+
+    for question_id, count in per_question.items():
+        Question.objects.filter(pk=question_id)\
+                .update(view_count=F('view_count') + count)
+
+# don't lose the queue when the process shuts down cleanly
+atexit.register(flush)
@@ -1,65 +1,118 @@
 import datetime
+import operator
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.db.models import Sum
+from django.db import connection
+from django.db.models import F, Q
 from django.http import HttpResponse, HttpResponseRedirect, Http404
-from django.shortcuts import render_to_response, get_object_or_404
+from django.shortcuts import get_object_or_404
 from django.template import RequestContext
+from django.utils import simplejson
+from django.utils.http import urlencode
 
 import quanda.models
+from quanda import identity, leaderboards, parallel, questionlists, routers, viewcounts, votequeue
+from quanda import tags as tag_directory
+from quanda.caching import PAGE_CACHE_TIMEOUT, cache_anonymous_page, conditional_page, fragment_key, get_versions, invalidate_after, invalidate_question
 from quanda.forms import QuestionForm, QuestionTagForm, QuestionListForm, QuestionListOrderForm, QuestionListAddForm, AnswerForm, RepForm, ProfileForm, CommentForm
+from quanda.instrumentation import get_totals, render_to_response, section
 from quanda.models import Question, QuestionVote, QuestionTag, QuestionList, QuestionListOrder, QuestionView, Answer, AnswerVote, Profile, Comment
-from quanda.utils import get_user_rep
+from quanda.pagination import encode_cursor, paginate, paginate_ranked
+from quanda.related import get_related_questions
+from quanda.reputation import has_reputation
+from quanda.search import search_questions, with_tags
+from quanda.utils import save_fields
 
 TINY_MCE_JS_LOCATION = getattr(settings, 'TINY_MCE_JS_LOCATION', 'http://teebes.com/static/js/tiny_mce/tiny_mce.js')
+SEARCH_RESULTS_PER_PAGE = getattr(settings, 'SEARCH_RESULTS_PER_PAGE', 20)
+ANSWERS_PAGE_SIZE = getattr(settings, 'ANSWERS_PAGE_SIZE', 30)
+# comments shown under each post, and per click on "more comments"
+COMMENTS_SHOWN = getattr(settings, 'COMMENTS_SHOWN', 5)
+COMMENTS_PAGE_SIZE = getattr(settings, 'COMMENTS_PAGE_SIZE', 20)
 
 # === Index, Tags, Search & Profile ===
+def get_featured_questions():
+    try:    
+        return QuestionList.objects.get(title='featured').questions.all().order_by('questionlistorder__order')
+    except QuestionList.DoesNotExist:
+        return None
+
+@cache_anonymous_page('index', lambda: ['questions', 'lists'])
 def index(request):    
+    # the question lists are lazy, so none of them are read when their
+    # fragment is cached
+    question_lists = {
+        'featured': LazyList(get_featured_questions),
+        'top_questions': LazyList(lambda: leaderboards.get_questions('top')),
+        'recent_questions': LazyList(lambda: leaderboards.get_questions('recent')),
+        'hot_questions': LazyList(lambda: leaderboards.get_questions('hot')),
+        'unanswered_questions': LazyList(lambda: leaderboards.get_questions('unanswered')),
+        'your_answers': LazyList(lambda: None),
+    }
     if request.user.is_authenticated():
-        your_answers = Answer.objects.filter(question__author=request.user).order_by("-posted")[:5]
-    else:
-        your_answers = None
+        question_lists['your_answers'] = LazyList(lambda: Answer.objects\
+            .filter(question__author=request.user).order_by("-posted")[:5])
     
-    try:    
-        featured = QuestionList.objects.get(title='featured').questions.all().order_by('questionlistorder__order')
-    except QuestionList.DoesNotExist:
-        featured = None
-
-    return render_to_response('quanda/index.html', {
-        'featured': featured,
-        'top_questions': Question.objects.annotate(score=Sum('questionvotes__score')).order_by('-score')[:5],
-        'recent_questions': Question.objects.order_by("-posted")[:5],
-        'your_answers': your_answers,
-        'unanswered_questions': Question.objects.filter(answers__isnull=True).order_by('-posted')[:5],
-        }, context_instance=RequestContext(request))
+    questions_version, lists_version = get_versions('questions', 'lists')
+
+    if parallel.PARALLEL_QUERIES:
+        # the lists whose fragment isn't cached are read at once,
+        # concurrently, the others not at all
+        fragments = {
+            'recent_questions': fragment_key('quanda_index_panels', questions_version),
+            'top_questions': fragment_key('quanda_index_panels', questions_version),
+            'featured': fragment_key('quanda_index_featured', lists_version, questions_version),
+            'hot_questions': fragment_key('quanda_index_hot', questions_version),
+            'unanswered_questions': fragment_key('quanda_index_unanswered', questions_version),
+        }
+        cached = cache.get_many(fragments.values())
+        # each lazy list keeps what it fetched for the template
+        parallel.fetch(**dict([
+            (name, lazy.get) for name, lazy in question_lists.items()
+            if fragments.get(name) not in cached]))
+
+    context = {
+        'cache_timeout': PAGE_CACHE_TIMEOUT,
+        'questions_version': questions_version,
+        'lists_version': lists_version,
+        }
+    context.update(question_lists)
+    return render_to_response('quanda/index.html', context,
+                              context_instance=RequestContext(request))
 
 def search(request):
     """
-    At this time this search view doesn't even deserve the name. Need to
-    identify an existing search package and use it here.
+    Full text search over questions and their answers, optionally restricted
+    to some tags (passed as one or more 'tag' parameters). Without a query,
+    the most recent questions (with those tags) are listed.
     """
-    query = ''
-    if request.method == 'GET':
-        query = request.GET['query']
-    
-    if query == '': # if nothing is passed, return the 50 most recent questions
-        results = Question.objects.all().order_by('-posted')[:50]
+    query = request.GET.get('query', '').strip()
+    tags = [tag.lower() for tag in request.GET.getlist('tag') if tag]
+    cursor = request.GET.get('after')
+
+    if query:
+        page = paginate_ranked(search_questions(query, tags), cursor,
+                               per_page=SEARCH_RESULTS_PER_PAGE)
+        questions = Question.objects.in_bulk([row[0] for row in page])
+        results = [questions[row[0]] for row in page if row[0] in questions]
     else:
-        tags = QuestionTag.objects.values_list('title', flat=True)
-        present_tags = []
-        for word in query.split(' '):
-            if word in tags:
-                present_tags.append(word)
-    
-        results = Question.objects.filter(tags__title__in=present_tags).distinct().order_by('-posted')
+        questions = Question.objects.all()
+        if tags:
+            questions = with_tags(questions, tags)
+        page = paginate(questions, cursor, per_page=SEARCH_RESULTS_PER_PAGE)
+        results = page.object_list
 
     return render_to_response("quanda/search_results.html", {
         'results': results,
+        'page': page,
+        'query': query,
+        'search_params': urlencode([('query', query)] + [('tag', tag) for tag in tags]),
         }, context_instance=RequestContext(request))
-    return HttpResponse("search")
 
 def profile(request, username):
     
@@ -73,7 +126,7 @@ def profile(request, username):
             rep_form = RepForm(request.POST)
             if rep_form.is_valid():
                 profile.reputation = rep_form.cleaned_data['base_rep']
-                profile.save()
+                save_fields(profile, 'reputation')
                 return HttpResponseRedirect(reverse('quanda_public_profile', args=[username]))
         elif request.POST.has_key('save_profile'):
             if not request.user == profile.user:
@@ -90,16 +143,22 @@ def profile(request, username):
     return render_to_response("quanda/profile.html", {
         'rep_form': rep_form,
         'profile_form': profile_form,
-        'questions': Question.objects.filter(author__username=username).order_by('-posted'),
-        'answers': Answer.objects.filter(author__username=username).order_by('-posted'),
+        'questions': paginate(Question.objects.filter(author=user),
+                              request.GET.get('questions_after')),
+        'answers': paginate(Answer.objects.filter(author=user).select_related('question'),
+                            request.GET.get('answers_after')),
         'profile': profile,
         'tinymce': TINY_MCE_JS_LOCATION,
         }, context_instance=RequestContext(request))
 
 
+@cache_anonymous_page('tag', lambda tag_id: ['tag:%s' % tag_id, 'tags', 'questions'])
 def view_tag(request, tag_id):
+    tag = get_object_or_404(QuestionTag, pk=tag_id)
+    page = paginate(tag.questions.all(), request.GET.get('after'))
     return render_to_response("quanda/search_results.html", {
-        'results': QuestionTag.objects.get(pk=tag_id).questions.order_by('-posted'),
+        'results': page.object_list,
+        'page': page,
         }, context_instance=RequestContext(request))
     return HttpResponse("This is tag %s" % tag_id)
 
@@ -120,8 +179,8 @@ def question_create_edit(request, question_id=None):
     else:        
         tags = []
         if question:
-            tags = question.tags.values_list('id', flat=True)
-        form = QuestionForm(request.user, instance=question, initial={'tags': tags})
+            tags = question.tags.values_list('title', flat=True)
+        form = QuestionForm(request.user, instance=question, initial={'tags': ', '.join(tags)})
     
     return render_to_response('quanda/question_create_edit.html', {
         'form': form,
@@ -129,8 +188,145 @@ def question_create_edit(request, question_id=None):
         }, context_instance=RequestContext(request))
 
     
-def question_read(request, question_id=None, msg=None, context={}):
-    question = get_object_or_404(Question, pk=question_id)
+class LazyList(object):
+    """
+    The list returned by func, looked up the first time the template goes
+    through it, so a fragment served from the cache never runs its queries.
+    (The templates of django 1.1 and 1.2 don't call callables found in the
+    context, they'd iterate over the function itself.)
+    """
+    def __init__(self, func):
+        self.func = func
+        self.items = None
+
+    def get(self):
+        if self.items is None:
+            self.items = list(self.func() or [])
+        return self.items
+
+    def __iter__(self):
+        return iter(self.get())
+
+    def __len__(self):
+        return len(self.get())
+
+def first_comments_where():
+    """
+    The where clause keeping only the first COMMENTS_SHOWN comments of each
+    post: those with fewer earlier comments on the same post. Each count is
+    an index range scan (see sql/comment.sql).
+    """
+    table = connection.ops.quote_name(Comment._meta.db_table)
+    return '''(SELECT COUNT(*) FROM %(table)s earlier
+               WHERE earlier.content_type_id = %(table)s.content_type_id
+               AND earlier.object_id = %(table)s.object_id
+               AND (earlier.posted < %(table)s.posted
+                    OR (earlier.posted = %(table)s.posted
+                        AND earlier.id < %(table)s.id))) < %%s''' % {'table': table}
+
+class PageComments(object):
+    """
+    The first COMMENTS_SHOWN comments of a question and of each of its
+    answers, fetched together in one query the first time any of them is
+    iterated over. Pages whose comment fragments are all cached never run
+    the query, and neither do pages without comments.
+    """
+    def __init__(self, question, answers):
+        self.question = question
+        self.answers = answers
+        self.comments = None
+
+    @section('comments')
+    def load(self):
+        self.comments = {}
+        question_type = ContentType.objects.get_for_model(Question)
+        answer_type = ContentType.objects.get_for_model(Answer)
+        lookups = []
+        if self.question.comment_count:
+            lookups.append(Q(content_type=question_type, object_id=self.question.id))
+        commented = [answer for answer in self.answers if answer.comment_count]
+        if commented:
+            lookups.append(Q(content_type=answer_type,
+                             object_id__in=[answer.id for answer in commented]))
+        if not lookups:
+            return
+
+        comments = Comment.objects.filter(reduce(operator.or_, lookups))\
+                   .select_related('user')
+        if max([self.question.comment_count] + [answer.comment_count for answer in
+                commented]) > COMMENTS_SHOWN:
+            comments = comments.extra(where=[first_comments_where()],
+                                      params=[COMMENTS_SHOWN])
+        identity.current().add_users([comment.user for comment in comments])
+        for comment in comments:
+            key = (comment.content_type_id == question_type.id, comment.object_id)
+            self.comments.setdefault(key, []).append(comment)
+
+    def get(self, is_question, object_id):
+        if self.comments is None:
+            self.load()
+        return self.comments.get((is_question, object_id), [])
+
+class CommentList(object):
+    """
+    The comments of one post shown on the page, as served by a PageComments,
+    with what's needed to link to the rest
+    """
+    def __init__(self, page_comments, post, is_question):
+        self.page_comments = page_comments
+        self.is_question = is_question
+        self.object_id = post.id
+        self.count = post.comment_count
+        self.more_url = reverse('quanda_comments', args=[
+            is_question and 'question' or 'answer', post.id])
+
+    def __iter__(self):
+        return iter(self.page_comments.get(self.is_question, self.object_id))
+
+    def __len__(self):
+        return len(self.page_comments.get(self.is_question, self.object_id))
+
+    def more_count(self):
+        return max(self.count - len(self), 0)
+
+    def next_cursor(self):
+        comments = self.page_comments.get(self.is_question, self.object_id)
+        if not comments or not self.more_count():
+            return None
+        return encode_cursor([comments[-1].posted, comments[-1].id])
+
+def attach_comments(question, answers):
+    """
+    Sets a comment_list attribute on the question and each of its answers.
+    All of them are fetched in a single query, on first use.
+    """
+    page_comments = PageComments(question, answers)
+    question.comment_list = CommentList(page_comments, question, True)
+    for answer in answers:
+        answer.comment_list = CommentList(page_comments, answer, False)
+
+def comments(request, post_type, object_id):
+    """
+    The comments of a post after the ones shown on the question page, as an
+    html fragment for the page to insert
+    """
+    model = {'question': Question, 'answer': Answer}[post_type]
+    post = get_object_or_404(model, pk=object_id)
+    page = paginate(Comment.objects.filter(
+                        content_type=ContentType.objects.get_for_model(model),
+                        object_id=post.id).select_related('user'),
+                    request.GET.get('after'), descending=False,
+                    per_page=COMMENTS_PAGE_SIZE)
+    page.more_url = request.path
+    return render_to_response('quanda/comments.html', {
+        'comments': page,
+        }, context_instance=RequestContext(request))
+
+@conditional_page(lambda question_id=None, **kwargs: ['question:%s' % question_id])
+@cache_anonymous_page('question', lambda question_id=None, **kwargs: ['question:%s' % question_id])
+def question_read(request, question_id=None, msg=None, context=None):
+    context = dict(context or {})
+    question = get_object_or_404(Question.objects.select_related('author'), pk=question_id)
     
     # user answers question
     answer_form = AnswerForm(request.user, question)    
@@ -147,73 +343,99 @@ def question_read(request, question_id=None, msg=None, context={}):
         # requirement to leave comments        
         if request.user.is_authenticated():
             required_rep = getattr(settings, 'LEAVE_COMMENT', 0)
-            if get_user_rep(request.user.username) >= required_rep:
+            if has_reputation(request.user, required_rep):
                 comment_form = CommentForm(request.POST)
                 if comment_form.is_valid():
                     # create the comment and redirect         
-                    comment = Comment(
-                        content_object = getattr(
-                            quanda.models,
-                            comment_form.cleaned_data['content_type'],
-                            ).objects.get(pk=comment_form.cleaned_data['object_id']),
-                        comment_text = comment_form.cleaned_data['comment_text'],
-                        posted = datetime.datetime.now(),
-                        user = request.user,
-                        ip = request.META['REMOTE_ADDR'],
-                    )
-                    comment.save()
+                    post_comment(request, comment_form)
                     return HttpResponseRedirect(reverse('quanda_question_read', args=[question_id]))
             else:
                 context['msg'] = "You must have at least %s reputation in order to leave comments " % required_rep
         else:
             context['msg'] = "You must be logged in to comment"
 
-    # get how the user previously voted on this question
-    try:
-        user_question_previous_vote = QuestionVote.objects.get(question=question, user=request.user).score
-    except Exception:
-        user_question_previous_vote = 0
-
-    # get questions related to this one
-    related_questions = Question.objects\
-                        .filter(tags__id__in=question.tags.all())\
-                        .exclude(pk=question.id)\
-                        .distinct()\
-                        .order_by('-posted')
-
-    answers_q = Answer.objects\
-                .filter(question=question)\
-                .annotate(score=Sum('answervotes__score'))\
-                .order_by('-posted')\
-                .order_by('-score')\
-                .order_by('-user_chosen')    
+    # the lookups below don't depend on each other, and run concurrently
+    # with PARALLEL_QUERIES on (see quanda.parallel)
+    lookups = {
+        # chosen answer first, then by score, then newest first, a page at a
+        # time (see sql/answer.sql for the index this walks)
+        'answers_page': lambda: paginate(Answer.objects.filter(question=question)
+                                         .select_related('author'),
+                                         request.GET.get('answers_after'),
+                                         fields=('user_chosen', 'score', 'posted', 'id'),
+                                         per_page=ANSWERS_PAGE_SIZE),
+    }
+    # get how the user previously voted on this question and its answers,
+    # each in a single query
+    if request.user.is_authenticated():
+        lookups['question_vote'] = lambda: list(QuestionVote.objects\
+            .filter(question=question, user=request.user).values_list('score', flat=True))
+        lookups['answer_votes'] = lambda: dict(AnswerVote.objects\
+            .filter(answer__question=question, user=request.user)\
+            .values_list('answer', 'score'))
+        if votequeue.VOTE_WRITE_BEHIND:
+            lookups['queued_votes'] = lambda: votequeue.get_queued_votes(request.user, question)
+    fetched = parallel.fetch(**lookups)
+
+    answers_page = fetched['answers_page']
+    user_question_previous_vote = (fetched.get('question_vote') or [0])[0]
+    user_answer_votes = fetched.get('answer_votes', {})
+    if 'queued_votes' in fetched:
+        # votes still in the queue win over the ones already applied
+        queued_question_vote, queued_answer_votes = fetched['queued_votes']
+        if queued_question_vote is not None:
+            user_question_previous_vote = queued_question_vote
+        user_answer_votes.update(queued_answer_votes)
+
+    # get questions related to this one (lazily, so they're only looked up
+    # when the sidebar isn't cached)
+    related_questions = LazyList(lambda: get_related_questions(question))
 
     user_answered_question = False # whether this user answered the question    
     answers = []
-    for answer in answers_q:
+    for answer in answers_page:
         # did the user answer the question?
         if answer.author == request.user:
             user_answered_question = True
         
         # indicates the user's last vote on this answer
-        try:
-            answer_vote = AnswerVote.objects.get(answer=answer, user=request.user).score
-        except Exception:
-            answer_vote = 0
-        answer.user_prev_vote = answer_vote
+        answer.user_prev_vote = user_answer_votes.get(answer.id, 0)
         
         answer.comment_form = CommentForm(initial={'content_type': 'Answer', 'object_id': answer.id})        
         
         answers.append(answer)
 
+    attach_comments(question, answers)
+
+    # their answer may be on another page
+    if request.user.is_authenticated() and not user_answered_question:
+        user_answered_question = bool(Answer.objects.filter(
+            question=question, author=request.user).values_list('id')[:1])
+
+    # the rep of everyone on the page is loaded in one query, the first time
+    # a fragment showing one is rendered
+    page_users = identity.current()
+    page_users.add_users([question.author] + [answer.author for answer in answers])
+    page_users.prime([question.author_id, request.user.id] +
+                     [answer.author_id for answer in answers])
+
     # add comment form to the question
     question.comment_form = CommentForm(initial={'content_type': 'Question', 'object_id': question.id})
 
+    # per fragment versions, so a vote on one answer only rerenders that one
+    versions = get_versions(*['question:%s' % question.id] +
+                            ['answer:%s' % answer.id for answer in answers])
+    question.cache_version = versions[0]
+    for answer, version in zip(answers, versions[1:]):
+        answer.cache_version = version
+
     context['question'] = question
+    context['cache_timeout'] = PAGE_CACHE_TIMEOUT
     context['user_question_previous_vote'] = user_question_previous_vote
     context['related_questions'] = related_questions
     context['answer_form'] = answer_form
     context['answers'] = answers
+    context['answers_page'] = answers_page
     context['user_answered_question'] = user_answered_question
     context['tinymce'] = TINY_MCE_JS_LOCATION
 
@@ -221,15 +443,41 @@ def question_read(request, question_id=None, msg=None, context={}):
                                context,
                                context_instance=RequestContext(request))
 
-def record_view(request, question_id):
+@invalidate_after
+def post_comment(request, comment_form):
     """
-    Keep track of a question's view count.
-    In order to keep as accurate as possible, session keys are checked
-    This view should preferably be called either via Ajax or as a stylesheet
-    to help avoid search engines polluting the view count
+    Saves the comment of a valid CommentForm, posted by the request's user.
+    The cached pages showing the post are only invalidated once its comment
+    count is updated too.
     """
-
-    question = get_object_or_404(Question, pk=question_id)
+    model_name = comment_form.cleaned_data['content_type']
+    if model_name not in ('Question', 'Answer'):
+        raise Http404
+    comment = Comment(
+        content_object = get_object_or_404(getattr(quanda.models, model_name),
+                                           pk=comment_form.cleaned_data['object_id']),
+        comment_text = comment_form.cleaned_data['comment_text'],
+        posted = datetime.datetime.now(),
+        user = request.user,
+        ip = request.META['REMOTE_ADDR'],
+    )
+    comment.save()
+    comment.content_object.__class__.objects.filter(pk=comment.object_id)\
+            .update(comment_count=F('comment_count') + 1)
+    routers.user_wrote()
+    return comment
+
+def count_view(request, question):
+    """
+    Counts a view of the question unless this session already viewed it, and
+    returns the question's view count.
+    With VIEW_BUFFERING on, views are queued and written in bulk instead (see
+    quanda.viewcounts)
+    """
+    if viewcounts.VIEW_BUFFERING:
+        return viewcounts.record_view(question,
+                                      request.META['REMOTE_ADDR'],
+                                      request.session.session_key)
 
     if not QuestionView.objects.filter(
                     question=question,
@@ -239,8 +487,29 @@ def record_view(request, question_id):
                             created=datetime.datetime.now(),
                             session=request.session.session_key)
         view.save()
-    
-    return HttpResponse(u"%s" % QuestionView.objects.filter(question=question).count())
+        Question.objects.filter(pk=question.pk)\
+                .update(view_count=F('view_count') + 1)
+        question.view_count += 1
+    return question.view_count
+
+def record_view(request, question_id):
+    """
+    Keep track of a question's view count.
+    In order to keep as accurate as possible, session keys are checked
+    This view should preferably be called either via Ajax or as a stylesheet
+    to help avoid search engines polluting the view count
+    """
+    question = get_object_or_404(Question, pk=question_id)
+    return HttpResponse(u"%s" % count_view(request, question))
+
+def choose_answer(answer):
+    "Makes answer the chosen answer of its question"
+    # update the flags alone so the stored scores aren't written back stale
+    Answer.objects.filter(question=answer.question, user_chosen=True)\
+            .update(user_chosen=False)
+    Answer.objects.filter(pk=answer.pk).update(user_chosen=True)
+    answer.user_chosen = True
+    invalidate_question(answer.question_id)
 
 @login_required
 def pick_answer(request, answer_id=None):
@@ -252,14 +521,7 @@ def pick_answer(request, answer_id=None):
     if answer.question.author != request.user:
         return HttpResponse("This is not your question to answer")
     
-    try:
-        already_chosen = Answer.objects.get(question=answer.question, user_chosen=True)
-        already_chosen.user_chosen = False
-        already_chosen.save()
-    except Answer.DoesNotExist: pass
-
-    answer.user_chosen = True
-    answer.save()
+    choose_answer(answer)
     
     return HttpResponseRedirect(reverse('quanda_question_read', args=[answer.question.id]))
 
@@ -299,7 +561,7 @@ def tags_admin(request):
         new_tag_form = QuestionTagForm()
     
     return render_to_response("quanda/tags_admin.html", {
-        'tags': QuestionTag.objects.all(),
+        'tags': tag_directory.get_directory(),
         'new_tag_form': new_tag_form,
         }, context_instance=RequestContext(request))
     
@@ -344,44 +606,41 @@ def list_details(request, list_id):
                 return HttpResponseRedirect(reverse('quanda_list_details', args=[list.id]))
 
         elif request.POST.has_key('reorder'):
-            for value in request.POST.values():
-                if value != '0' and request.POST.values().count(value) > 1:
-                    invalid_count = True
-                    break
-            if not invalid_count:
-                for k, v in request.POST.items():
-                    if k != 'reorder':
-                        list_item = questions_list.get(question__id=k)
-                        if v == '0':
-                            list_item.delete()
-                        else:
-                            list_item.order = v
-                            list_item.save()
+            try:
+                questionlists.reorder(list, dict([(int(k), int(v)) for k, v in
+                                                  request.POST.items() if k != 'reorder']))
+            except (ValueError, questionlists.InvalidOrder):
+                invalid_count = True
+            else:
                 return HttpResponseRedirect(reverse('quanda_list_details', args=[list.id]))
 
         elif request.POST.has_key('add_question'):
             add_question_form = QuestionListAddForm(list, request.POST)
             if add_question_form.is_valid():
                 question = get_object_or_404(Question, pk=add_question_form.cleaned_data['question'])            
-                list_questions = QuestionListOrder.objects.filter(question_list=list)
-                if not list_questions:
-                    new_item = QuestionListOrder(question_list=list, question=question, order=1)
-                    new_item.save()
-                    return HttpResponseRedirect(reverse('quanda_list_details', args=[list.id]))
-                else:
-                    order_number = list_questions.order_by('-order')[0].order + 1
-                    new_item = QuestionListOrder(question_list=list, question=question, order=order_number)
-                    new_item.save()
-                    return HttpResponseRedirect(reverse('quanda_list_details', args=[list.id]))
+                questionlists.append(list, question)
+                return HttpResponseRedirect(reverse('quanda_list_details', args=[list.id]))
 
     return render_to_response("quanda/list_details.html", {
         'list': list,
         'edit_form': edit_form,
         'add_question_form': add_question_form,
-        'questions_list': questions_list,
+        'questions_list': paginate(questions_list.select_related('question'),
+                                   request.GET.get('after'),
+                                   fields=('order', 'id'), descending=False),
         'invalid_count': invalid_count,
     }, context_instance=RequestContext(request))
 
+@login_required
+def stats(request):
+    """
+    The instrumentation totals of this process since it started, as json.
+    Only filled in when the INSTRUMENTATION setting is on.
+    """
+    if not request.user.is_staff: return HttpResponse("Unauthorized")
+    return HttpResponse(simplejson.dumps(get_totals(), indent=2, sort_keys=True),
+                        mimetype='application/json')
+
 @login_required
 def install(request):
     """
@@ -404,6 +663,6 @@ def install(request):
         if user.is_staff:
             if profile.reputation < 1000:
                 profile.reputation = 1000
-                profile.save()
+                save_fields(profile, 'reputation')
     
     return HttpResponse("done")
\ No newline at end of file
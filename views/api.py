@@ -0,0 +1,96 @@
+"""
+JSON versions of the actions on the question page, for the page to call with
+ajax and update itself in place instead of being reloaded. Each returns a
+small json object, or {"error": message} with a 4xx status. Also the tag
+autocompletion of the ask page.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import simplejson
+from django.views.decorators.http import require_POST
+
+from quanda import tags
+from quanda.caching import invalidate_after
+from quanda.forms import CommentForm
+from quanda.models import Question, Answer
+from quanda.reputation import has_reputation
+from quanda.views import choose_answer, count_view, post_comment
+from quanda.views.voting import VoteRefused, vote_on_question, vote_on_answer
+
+def json_response(data, status=200):
+    response = HttpResponse(simplejson.dumps(data), mimetype='application/json')
+    response.status_code = status
+    return response
+
+def json_error(message, status=403):
+    return json_response({'error': message}, status)
+
+@require_POST
+@invalidate_after
+@transaction.commit_on_success
+def question_vote(request, question_id, delta=0):
+    question = get_object_or_404(Question, pk=question_id)
+    try:
+        vote_on_question(request.user, question, delta)
+    except VoteRefused as refused:
+        return json_error(refused.args[0])
+    return json_response({
+        'score': question.score,
+        'vote_count': question.vote_count,
+        'vote': delta,
+    })
+
+@require_POST
+@invalidate_after
+@transaction.commit_on_success
+def answer_vote(request, answer_id, delta=0):
+    answer = get_object_or_404(Answer, pk=answer_id)
+    try:
+        vote_on_answer(request.user, answer, delta)
+    except VoteRefused as refused:
+        return json_error(refused.args[0])
+    return json_response({
+        'score': answer.score,
+        'vote_count': answer.vote_count,
+        'vote': delta,
+    })
+
+@require_POST
+def pick_answer(request, answer_id):
+    answer = get_object_or_404(Answer.objects.select_related('question'), pk=answer_id)
+    if answer.question.author != request.user:
+        return json_error("This is not your question to answer")
+    choose_answer(answer)
+    return json_response({'chosen': answer.id})
+
+def record_view(request, question_id):
+    question = get_object_or_404(Question, pk=question_id)
+    return json_response({'view_count': count_view(request, question)})
+
+@require_POST
+def comment(request):
+    if not request.user.is_authenticated():
+        return json_error("You must be logged in to comment", 401)
+    required_rep = getattr(settings, 'LEAVE_COMMENT', 0)
+    if not has_reputation(request.user, required_rep):
+        return json_error("You must have at least %s reputation in order to leave comments " % required_rep)
+
+    comment_form = CommentForm(request.POST)
+    if not comment_form.is_valid():
+        return json_error(dict([(field, [unicode(error) for error in errors])
+                                for field, errors in comment_form.errors.items()]), 400)
+    comment = post_comment(request, comment_form)
+    return json_response({
+        'id': comment.id,
+        'comment_text': comment.comment_text,
+        'user': request.user.username,
+        'posted': comment.posted.isoformat(),
+    })
+
+def tag_complete(request):
+    "The tags starting with the 'prefix' parameter, most used first"
+    return json_response([{'title': tag['title'], 'count': tag['question_count']}
+                          for tag in tags.complete(request.GET.get('prefix', ''))])
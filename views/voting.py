@@ -1,98 +1,110 @@
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.db import transaction
 from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
 
-from quanda.models import Question, QuestionVote, Answer, AnswerVote
-from quanda.utils import get_user_rep
+from quanda import leaderboards, routers, votequeue
+from quanda.caching import invalidate_after
+from quanda.models import Question, QuestionVote, Answer, AnswerVote, VoteConflict
+from quanda.reputation import has_reputation, record_vote
+from quanda.utils import adjust_vote_counters
 from quanda.views import question_read
 
-def question_adjust_vote(request, question_id, delta=0):
-    vote_question_up_rep = getattr(settings, 'VOTE_QUESTION_UP_REP', 20)
-    vote_question_down_rep = getattr(settings, 'VOTE_QUESTION_DOWN_REP', 100)
-    
-    if not request.user.is_authenticated():
+class VoteRefused(Exception):
+    "Raised with the message to show the user when they may not cast a vote"
+
+def check_vote_rep(user, delta, post_type, up_rep, down_rep):
+    "Raises VoteRefused unless the user has the rep to vote on a post_type"
+    if not user.is_authenticated():
         if delta == 1:
-            msg = "You need to sign up and get at least %s rep to vote up a question" % vote_question_up_rep
+            raise VoteRefused("You need to sign up and get at least %s rep to vote up %s" % (up_rep, post_type))
         elif delta == -1:
-            msg = "You need to sign up and get at least %s rep to vote down a question" % vote_question_down_rep
-        else: msg = None
-        return question_read(request, question_id, context={'msg': msg})
-    
-    if delta == 1 and get_user_rep(request.user.username) < vote_question_up_rep:
-        return question_read(
-            request,
-            question_id,
-            context={'msg': "You need at least %s rep to vote up a question"\
-                     % vote_question_up_rep}
-        )
-    elif delta == -1 and get_user_rep(request.user.username) < vote_question_down_rep:
-        return question_read(
-            request,
-            question_id,
-            context={'msg': "You need at least %s rep to vote down a question"\
-                    % vote_question_down_rep}
-        )
-    
-    question = get_object_or_404(Question, pk=question_id)
+            raise VoteRefused("You need to sign up and get at least %s rep to vote down %s" % (down_rep, post_type))
+        raise VoteRefused(None)
+
+    if delta == 1 and not has_reputation(user, up_rep):
+        raise VoteRefused("You need at least %s rep to vote up %s" % (up_rep, post_type))
+    elif delta == -1 and not has_reputation(user, down_rep):
+        raise VoteRefused("You need at least %s rep to vote down %s" % (down_rep, post_type))
+
+def queue_optimistic_vote(user, obj, delta, **target):
+    """
+    Queues the vote when votes are written behind, and updates the score of
+    obj in memory to what it will be once the vote is applied. The stored
+    score only counts applied votes, so the change is worked out from the
+    user's applied vote, not from one of theirs still in the queue.
+    """
+    applied_score = votequeue.get_applied_vote(user, **target)
+    votequeue.queue_vote(user, delta, **target)
+    obj.score += delta - applied_score
+    obj.vote_count += int(delta != 0) - int(applied_score != 0)
+
+def vote_on_question(user, question, delta):
+    """
+    Sets the user's vote on the question to delta, updating the question's
+    score and its author's rep (or queues the vote, with VOTE_WRITE_BEHIND
+    on). Raises VoteRefused if the user may not vote. Has to run inside a
+    transaction.
+    """
+    check_vote_rep(user, delta, 'a question',
+                   getattr(settings, 'VOTE_QUESTION_UP_REP', 20),
+                   getattr(settings, 'VOTE_QUESTION_DOWN_REP', 100))
+
+    if user == question.author:
+        raise VoteRefused("You cannot vote on your own questions")
+
+    routers.user_wrote()
+    if votequeue.VOTE_WRITE_BEHIND:
+        return queue_optimistic_vote(user, question, delta, question=question)
+
+    try:
+        question_vote, previous_score = QuestionVote.objects.set_vote(
+            user, delta, question=question)
+    except VoteConflict:
+        raise VoteRefused("Your vote could not be recorded, please try again")
+    record_vote(question_vote, previous_score)
+    adjust_vote_counters(question, previous_score, delta)
+    leaderboards.question_scored(question)
+
+def vote_on_answer(user, answer, delta):
+    "Same as vote_on_question, for answers"
+    check_vote_rep(user, delta, 'an answer',
+                   getattr(settings, 'VOTE_ANSWER_UP_REP', 20),
+                   getattr(settings, 'VOTE_ANSWER_DOWN_REP', 100))
+
+    if user == answer.author:
+        raise VoteRefused("You cannot vote on your own answers")
 
-    if request.user == question.author:
-        return question_read(
-            request,
-            question_id,
-            context={'msg': "You cannot vote on your own questions"}
-        )
+    routers.user_wrote()
+    if votequeue.VOTE_WRITE_BEHIND:
+        return queue_optimistic_vote(user, answer, delta, answer=answer)
 
     try:
-        question_vote = QuestionVote.objects.get(question=question, user=request.user)
-    except QuestionVote.DoesNotExist:
-        question_vote = QuestionVote(question=question, user=request.user)    
-    question_vote.score = delta
-    question_vote.save()
+        answer_vote, previous_score = AnswerVote.objects.set_vote(
+            user, delta, answer=answer)
+    except VoteConflict:
+        raise VoteRefused("Your vote could not be recorded, please try again")
+    record_vote(answer_vote, previous_score)
+    adjust_vote_counters(answer, previous_score, delta)
+
+@invalidate_after
+@transaction.commit_on_success
+def question_adjust_vote(request, question_id, delta=0):
+    question = get_object_or_404(Question, pk=question_id)
+    try:
+        vote_on_question(request.user, question, delta)
+    except VoteRefused as refused:
+        return question_read(request, question_id, context={'msg': refused.args[0]})
     return HttpResponseRedirect(reverse('quanda_question_read', args=[question_id]))
 
+@invalidate_after
+@transaction.commit_on_success
 def answer_adjust_vote(request, answer_id, delta=0):
     answer = get_object_or_404(Answer, pk=answer_id)
-    
-    vote_answer_up_rep = getattr(settings, 'VOTE_ANSWER_UP_REP', 20)
-    vote_answer_down_rep = getattr(settings, 'VOTE_ANSWER_DOWN_REP', 100)
-    
-    if not request.user.is_authenticated():
-        if delta == 1:
-            msg = "You need to sign up and get at least %s rep to vote up an answer" % vote_answer_up_rep
-        elif delta == -1:
-            msg = "You need to sign up and get at least %s rep to vote down an answer" % vote_answer_down_rep
-        else: msg = None
-        return question_read(request, answer.question.id, context={'msg': msg})
-        
-    if delta == 1 and get_user_rep(request.user.username) < vote_answer_up_rep:
-        return question_read(
-            request,
-            answer.question.id,
-            context={'msg': "You need at least %s rep to vote up an answer"\
-                     % vote_answer_up_rep}
-        )
-    elif delta == -1 and get_user_rep(request.user.username) < vote_answer_down_rep:
-        return question_read(
-            request,
-            answer.question.id,
-            context={'msg': "You need at least %s rep to vote down an answer"\
-                    % vote_answer_down_rep}
-        )    
-    
-    if request.user == answer.author:
-        return question_read(
-            request,
-            answer.question_id,
-            context={'msg': "You cannot vote on your own answers"}
-        )
-    
     try:
-        answer_vote = AnswerVote.objects.get(answer=answer, user=request.user)
-    except AnswerVote.DoesNotExist:
-        answer_vote = AnswerVote(answer=answer, user=request.user)
-    answer_vote.score = delta
-    answer_vote.save()
-    return HttpResponseRedirect(reverse('quanda_question_read', args=[answer.question.id]))
-    
\ No newline at end of file
+        vote_on_answer(request.user, answer, delta)
+    except VoteRefused as refused:
+        return question_read(request, answer.question_id, context={'msg': refused.args[0]})
+    return HttpResponseRedirect(reverse('quanda_question_read', args=[answer.question_id]))
@@ -0,0 +1,118 @@
+"""
+Write-behind voting.
+
+With VOTE_WRITE_BEHIND on, the voting views don't touch the vote tables or
+the counters of the voted post: the vote is stored as a PendingVote, a single
+row per (user, question or answer) holding the user's latest vote, and the
+user is shown their vote right away. The process_vote_queue command applies
+the queued votes in batches, each in one transaction and with one counter
+update per voted post, so a question getting hundreds of votes a second
+doesn't have every request contend on the same rows.
+"""
+
+import datetime
+import operator
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F, Q
+
+from quanda import leaderboards
+from quanda.caching import invalidate, invalidate_after
+from quanda.models import Question, QuestionVote, Answer, AnswerVote, PendingVote
+from quanda.reputation import record_vote
+
+VOTE_WRITE_BEHIND = getattr(settings, 'VOTE_WRITE_BEHIND', False)
+VOTE_QUEUE_BATCH_SIZE = getattr(settings, 'VOTE_QUEUE_BATCH_SIZE', 500)
+
+def get_applied_vote(user, **target):
+    "Returns the user's vote on a target as applied, ignoring the queue"
+    model = 'question' in target and QuestionVote or AnswerVote
+    scores = model.objects.filter(user=user, **target)\
+             .values_list('score', flat=True)
+    return scores and scores[0] or 0
+
+def queue_vote(user, score, **target):
+    """
+    Queues the user's vote on a target (question=... or answer=...),
+    replacing any vote of theirs still in the queue.
+    """
+    now = datetime.datetime.now()
+    pending = PendingVote.objects.filter(user=user, **target)
+    if not pending.update(score=score, queued=now):
+        sid = transaction.savepoint()
+        try:
+            PendingVote.objects.create(user=user, score=score, queued=now, **target)
+        except IntegrityError:
+            # a concurrent request queued one first, last write wins
+            transaction.savepoint_rollback(sid)
+            pending.update(score=score, queued=now)
+        else:
+            transaction.savepoint_commit(sid)
+
+    # so the voter's next page load shows their vote
+    if 'question' in target:
+        invalidate('question:%s' % target['question'].id)
+    else:
+        invalidate('answer:%s' % target['answer'].id,
+                   'question:%s' % target['answer'].question_id)
+
+def get_queued_votes(user, question):
+    """
+    Returns the user's queued vote on the question (None if there is none)
+    and a dict of answer id to their queued votes on its answers.
+    """
+    question_score, answer_scores = None, {}
+    for question_id, answer_id, score in PendingVote.objects\
+            .filter(Q(question=question) | Q(answer__question=question), user=user)\
+            .values_list('question', 'answer', 'score'):
+        if question_id is not None:
+            question_score = score
+        else:
+            answer_scores[answer_id] = score
+    return question_score, answer_scores
+
+@invalidate_after
+@transaction.commit_on_success
+def apply_batch(batch_size=None):
+    """
+    Applies the oldest queued votes, up to batch_size of them, in a single
+    transaction: the votes themselves, the rep they earn, and one score and
+    vote count update per voted post. Returns the number of votes applied.
+    """
+    pending = list(PendingVote.objects
+                   .select_related('user', 'question__author', 'answer__author')
+                   .order_by('queued', 'id')[:batch_size or VOTE_QUEUE_BATCH_SIZE])
+    if not pending:
+        return 0
+
+    deltas = {}
+    for queued in pending:
+        if queued.question_id is not None:
+            vote, previous_score = QuestionVote.objects.set_vote(
+                queued.user, queued.score, question=queued.question)
+            key = (Question, queued.question_id)
+        else:
+            vote, previous_score = AnswerVote.objects.set_vote(
+                queued.user, queued.score, answer=queued.answer)
+            key = (Answer, queued.answer_id)
+        record_vote(vote, previous_score)
+
+        delta = deltas.setdefault(key, [0, 0])
+        delta[0] += queued.score - previous_score
+        delta[1] += int(queued.score != 0) - int(previous_score != 0)
+
+    for (model, pk), (score, vote_count) in deltas.items():
+        if score or vote_count:
+            model.objects.filter(pk=pk).update(score=F('score') + score,
+                                               vote_count=F('vote_count') + vote_count)
+
+    # votes changed again since they were read stay queued for the next batch
+    PendingVote.objects.filter(reduce(operator.or_, [
+        Q(pk=queued.pk, score=queued.score, queued=queued.queued)
+        for queued in pending])).delete()
+
+    for question in Question.objects.filter(
+            pk__in=[pk for model, pk in deltas if model is Question]):
+        leaderboards.question_scored(question)
+    return len(pending)